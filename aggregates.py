@@ -0,0 +1,51 @@
+import math
+import pandas as pd
+
+AGGREGATE_COLUMNS = ['role', 'purpose', 'currency', 'amount']
+
+class MonthlyAggregates:
+    ''' Running per (month, role, purpose, currency) totals.
+        Amounts are kept in the record currency and converted on read,
+        so a change of course never leaves stale totals behind.
+    '''
+    def __init__(self) -> None:
+        self.totals = {}
+
+    def rebuild(self, frames: pd.DataFrame) -> dict:
+        ''' recompute all totals from the grossbook history '''
+        stamps = frames['timestamp']
+        sums = frames.groupby(
+            [stamps.dt.year, stamps.dt.month, 'role', 'purpose', 'currency'],
+            observed=True
+        )['amount'].sum()
+        totals = {}
+        for (year, month, role, purpose, currency), amount in sums.items():
+            totals.setdefault((int(year), int(month)), {})[
+                role, purpose, currency
+            ] = float(amount)
+        return totals
+
+    def merge(self, totals: dict) -> None:
+        ''' add totals of a batch of records '''
+        for month, month_totals in totals.items():
+            current = self.totals.setdefault(month, {})
+            for key, amount in month_totals.items():
+                current[key] = current.get(key, 0.0) + amount
+
+    def is_consistent(self, totals: dict) -> bool:
+        if self.totals.keys() != totals.keys():
+            return False
+        for month, month_totals in totals.items():
+            current = self.totals[month]
+            if current.keys() != month_totals.keys():
+                return False
+            for key, amount in month_totals.items():
+                if not math.isclose(current[key], amount, abs_tol=1e-6):
+                    return False
+        return True
+
+def totals_frame(totals: dict) -> pd.DataFrame:
+    return pd.DataFrame(
+        [(*key, amount) for key, amount in totals.items()],
+        columns=AGGREGATE_COLUMNS
+    )
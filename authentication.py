@@ -1,20 +1,25 @@
-import json
 from telegram import update
+from config import configs
 
 class TelegramAuth:
     def __init__(self, telegram_config: str) -> None:
         self.config_name = telegram_config
-        with open(telegram_config) as f:
-            self.config = json.load(f)
+        configs.subscribe(telegram_config, self.apply)
+
+    def apply(self, config: dict) -> None:
+        self.allowed_users = frozenset(config['allowed_users'].values())
+        self.config = config
+
+    def close(self) -> None:
+        configs.unsubscribe(self.config_name, self.apply)
     
     def ok(self, update: update.Update) -> bool:
-        return update.effective_user.id in self.config['allowed_users'].values()
+        return update.effective_user.id in self.allowed_users
 
     def chats(self) -> list:
         return self.config['chats']
 
     def update_chats(self, newchat: int) -> None:
-        self.config['chats'].append(newchat)
-        with open(self.config_name, 'w') as f:
-            json.dump(self.config, f, indent=4)
-
+        config = dict(self.config, chats=self.config['chats'] + [newchat])
+        configs.store(self.config_name, config)
+        self.config = config
@@ -0,0 +1,72 @@
+''' Budget projection over long synthetic histories.
+
+    python -m benchmarks.forecast [--years 10] [--purposes 40] [--roles 3]
+        [--rows 200000] [--months 12] [--repeat 50]
+
+    history is reading the month totals from the running aggregates,
+    project builds the role × purpose × month arrays from them, report
+    is a whole uncached /forecast including the render.
+'''
+import time
+import argparse
+import statistics
+import tempfile
+from busines_logic import Logic
+from benchmarks.synthetic import make_grossbook, FakeUpdate
+
+def timed(func, repeat: int) -> float:
+    ''' median milliseconds of repeated calls '''
+    latencies = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        latencies.append(time.perf_counter() - start)
+    return statistics.median(latencies) * 1000
+
+def main() -> None:
+    arg_parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    arg_parser.add_argument('--years', type=float, default=10)
+    arg_parser.add_argument('--purposes', type=int, default=40)
+    arg_parser.add_argument('--roles', type=int, default=3)
+    arg_parser.add_argument('--rows', type=int, default=200000)
+    arg_parser.add_argument('--months', type=int, default=12)
+    arg_parser.add_argument('--repeat', type=int, default=50)
+    args = arg_parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        paths = make_grossbook(
+            directory, args.rows, roles=args.roles,
+            purposes=args.purposes, years=args.years
+        )
+        logic = Logic(
+            paths['database'], paths['telegram_config'],
+            paths['budget_config'], 'rub'
+        )
+        history = logic.database.get_history_totals()
+        first, current = min(history), max(history)
+
+        def report():
+            logic.cache.clear()
+            logic.get_forecast(FakeUpdate(), args.months)
+
+        results = {
+            'history': timed(logic.database.get_history_totals, args.repeat),
+            'project': timed(
+                lambda: logic.pay_calc.project(history, first, current, args.months),
+                args.repeat
+            ),
+            'report': timed(report, max(1, args.repeat // 10)),
+        }
+        projection = logic.pay_calc.project(history, first, current, args.months)
+        logic.close()
+    print(
+        f'{len(projection.months)} months × {len(projection.purposes)} purposes'
+        f' × {len(projection.roles)} roles, {args.rows} rows'
+    )
+    for name, milliseconds in results.items():
+        print(f'{name:<8} p50 {milliseconds:8.2f} ms')
+
+if __name__ == '__main__':
+    main()
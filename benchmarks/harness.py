@@ -0,0 +1,133 @@
+''' Latency and peak memory of the bot logic on synthetic grossbooks.
+
+    python -m benchmarks.harness [--sizes 1000 100000 1000000]
+        [--output results.json] [--baseline previous.json]
+
+    Every scenario runs with an empty report cache, so the numbers
+    are the full load, filter, aggregate and render path.
+'''
+import sys
+import json
+import time
+import argparse
+import platform
+import statistics
+import tempfile
+import tracemalloc
+import pandas as pd
+from busines_logic import Logic
+from benchmarks.synthetic import make_grossbook, FakeUpdate
+
+def scenarios(logic: Logic) -> dict:
+    # an alias of groceries, the budget carries an aliases section
+    buy = FakeUpdate('#food\nbenchmark\n-12.5 eur')
+    report = FakeUpdate()
+    return {
+        'buy': lambda: logic.buy(buy),
+        'get_expenses_stats': lambda: logic.get_expenses_stats(report),
+        'get_pocket_summary': lambda: logic.get_pocket_summary(report, 'eur'),
+        'get_groceries_summary': lambda: logic.get_groceries_summary(report, 'eur'),
+        'get_debt_summary': lambda: logic.get_debt_summary(report),
+        'get_forecast': lambda: logic.get_forecast(report),
+        'get_day_stats': lambda: logic.get_day_stats(report),
+        'dayly_job': logic.dayly_job,
+    }
+
+def percentile(latencies: list, fraction: float) -> float:
+    ordered = sorted(latencies)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+def measure(logic: Logic, scenario, repeat: int) -> dict:
+    latencies = []
+    for _ in range(repeat):
+        logic.cache.clear()
+        start = time.perf_counter()
+        scenario()
+        latencies.append(time.perf_counter() - start)
+    # tracing slows everything down, so memory gets a separate run
+    logic.cache.clear()
+    tracemalloc.start()
+    scenario()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        'p50_ms': percentile(latencies, 0.5) * 1000,
+        'p90_ms': percentile(latencies, 0.9) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+        'max_ms': max(latencies) * 1000,
+        'mean_ms': statistics.mean(latencies) * 1000,
+        'peak_kib': peak / 1024,
+    }
+
+def run(sizes: list, repeat: int, storage: str) -> list:
+    results = []
+    for rows in sizes:
+        with tempfile.TemporaryDirectory() as directory:
+            paths = make_grossbook(directory, rows, storage=storage)
+            start = time.perf_counter()
+            logic = Logic(
+                paths['database'], paths['telegram_config'],
+                paths['budget_config'], 'rub'
+            )
+            results.append({
+                'scenario': 'startup', 'rows': rows,
+                'p50_ms': (time.perf_counter() - start) * 1000,
+            })
+            for name, scenario in scenarios(logic).items():
+                result = measure(logic, scenario, repeat)
+                results.append(dict(scenario=name, rows=rows, **result))
+                print(
+                    f'{name:<22} {rows:>9} p50 {result["p50_ms"]:>9.2f} ms '
+                    f'p99 {result["p99_ms"]:>9.2f} ms '
+                    f'peak {result["peak_kib"]:>9.0f} KiB',
+                    file=sys.stderr
+                )
+    return results
+
+def compare(results: list, baseline: list) -> None:
+    previous = {(res['scenario'], res['rows']): res for res in baseline}
+    print(f'{"scenario":<22} {"rows":>9} {"p50 ms":>10} {"before":>10} {"change":>8}')
+    for res in results:
+        old = previous.get((res['scenario'], res['rows']))
+        if old is None:
+            continue
+        change = res['p50_ms'] / old['p50_ms'] - 1 if old['p50_ms'] else 0.0
+        print(
+            f'{res["scenario"]:<22} {res["rows"]:>9} {res["p50_ms"]:>10.2f} '
+            f'{old["p50_ms"]:>10.2f} {change:>+8.0%}'
+        )
+
+def main() -> None:
+    arg_parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    arg_parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 100000, 1000000])
+    arg_parser.add_argument('--repeat', type=int, default=20)
+    arg_parser.add_argument('--storage', default='grossbook.db',
+                            help='grossbook.db, grossbook.arrow or grossbook')
+    arg_parser.add_argument('--output', help='write results as json')
+    arg_parser.add_argument('--baseline', help='json of an earlier run to compare with')
+    args = arg_parser.parse_args()
+
+    results = run(args.sizes, args.repeat, args.storage)
+    report = {
+        'meta': {
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'pandas': pd.__version__,
+            'storage': args.storage,
+            'repeat': args.repeat,
+        },
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(report, output, indent=4)
+    if args.baseline:
+        with open(args.baseline) as baseline:
+            compare(results, json.load(baseline)['results'])
+    else:
+        json.dump(report, sys.stdout, indent=4)
+
+if __name__ == '__main__':
+    main()
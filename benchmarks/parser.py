@@ -0,0 +1,52 @@
+''' Messages per second through MessageParser.
+
+    python -m benchmarks.parser [--messages N] [--batch N]
+'''
+import argparse
+import time
+from message_parser import MessageParser
+
+BUDGET = {
+    'expenses': [
+        {'purpose': purpose, 'role': 'ann'}
+        for purpose in ['groceries', 'rent', 'communal', 'internet', 'transport']
+    ],
+    'aliases': {'food': 'groceries'},
+}
+TELEGRAM = {'allowed_users': {'ann': 1, 'bob': 2}}
+
+ENTRIES = [
+    '#groceries\nmilk and bread\n-12.5 €',
+    '#food\nweekly shopping\n-80eur',
+    '#rent\n-900 EUR',
+    '#comm\nwater, gas\n-45.10 $',
+    '#pocket_money\ncinema\n-15 rub',
+]
+
+def run(parser: MessageParser, messages: list) -> float:
+    start = time.perf_counter()
+    for message in messages:
+        records, status = parser.parse(message, 1, '01.05.2024', '12:00')
+        assert records is not None, status
+    return time.perf_counter() - start
+
+def main() -> None:
+    arg_parser = argparse.ArgumentParser(description=__doc__)
+    arg_parser.add_argument('--messages', type=int, default=100000)
+    arg_parser.add_argument('--batch', type=int, default=10)
+    args = arg_parser.parse_args()
+
+    parser = MessageParser(BUDGET, TELEGRAM)
+    single = [ENTRIES[num % len(ENTRIES)] for num in range(args.messages)]
+    batched = [
+        '\n'.join(single[num:num + args.batch])
+        for num in range(0, len(single), args.batch)
+    ]
+    elapsed = run(parser, single)
+    print(f'single entry: {len(single) / elapsed:>12,.0f} messages/s')
+    elapsed = run(parser, batched)
+    print(f'{args.batch} entries:   {len(batched) / elapsed:>12,.0f} messages/s '
+          f'({len(single) / elapsed:,.0f} entries/s)')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+''' Render latency and peak memory of the report renderers.
+
+    python -m benchmarks.render [--repeat N] [--renderers table dfi]
+'''
+import argparse
+import statistics
+import time
+import tracemalloc
+import numpy as np
+import pandas as pd
+from render import RENDERERS
+
+# roughly /pocket, /left and /today of a busy month
+REPORT_SIZES = [3, 12, 60]
+
+def make_report(rows: int) -> pd.DataFrame:
+    rng = np.random.default_rng(rows)
+    return pd.DataFrame({
+        'date': [f'{day % 28 + 1:02d}.05.2024' for day in range(rows)],
+        'time': [f'{hour % 24:02d}:00' for hour in range(rows)],
+        'purpose': rng.choice(['groceries', 'rent', 'pocket_money'], rows),
+        'amount': rng.uniform(-300, 0, rows).round(2),
+        'currency': rng.choice(['eur', 'rub'], rows),
+        'description': ['weekly shopping'] * rows,
+    })
+
+def measure(renderer, frames: pd.DataFrame, repeat: int) -> dict:
+    renderer.render(frames)
+    latencies = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        renderer.render(frames)
+        latencies.append(time.perf_counter() - start)
+    # tracing slows everything down, so memory gets a separate run
+    tracemalloc.start()
+    renderer.render(frames)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        'median_ms': statistics.median(latencies) * 1000,
+        'max_ms': max(latencies) * 1000,
+        'peak_kib': peak / 1024,
+    }
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--renderers', nargs='+', default=list(RENDERERS))
+    args = parser.parse_args()
+
+    print(f'{"renderer":<8} {"rows":>5} {"median ms":>10} {"max ms":>10} {"peak KiB":>10}')
+    for name in args.renderers:
+        renderer = RENDERERS[name]()
+        for rows in REPORT_SIZES:
+            try:
+                result = measure(renderer, make_report(rows), args.repeat)
+            except ImportError as error:
+                # renderers import their backend on first use
+                print(f'{name:<8} skipped: {error}')
+                break
+            print(
+                f'{name:<8} {rows:>5} {result["median_ms"]:>10.1f} '
+                f'{result["max_ms"]:>10.1f} {result["peak_kib"]:>10.0f}'
+            )
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+''' Import time and time to first response of a fresh bot process.
+
+    python -m benchmarks.startup [--rows N] [--storage grossbook.db]
+        [--import-budget 500] [--response-budget 1000]
+
+    Every measurement is a new interpreter started in a directory
+    with a synthetic grossbook. The first start has no warm state and
+    parses the grossbook, it writes the warm state on close, the
+    second start loads that instead.
+'''
+import os
+import sys
+import json
+import argparse
+import subprocess
+import tempfile
+from benchmarks.synthetic import make_grossbook
+
+# runs inside the measured process, clock starts before run is imported
+PROBE = '''
+import sys, time, json
+start = time.perf_counter()
+sys.path.insert(0, {root!r})
+import run
+imported = time.perf_counter()
+from benchmarks.synthetic import FakeUpdate
+with run.households.use(run.households.route(1)) as household:
+    household.logic.get_day_stats(FakeUpdate())
+responded = time.perf_counter()
+run.households.close()
+print(json.dumps({{
+    'import_ms': (imported - start) * 1000,
+    'first_response_ms': (responded - start) * 1000,
+}}))
+'''
+
+def probe(directory: str) -> dict:
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    output = subprocess.run(
+        [sys.executable, '-c', PROBE.format(root=root)],
+        cwd=directory, capture_output=True, text=True, check=True
+    ).stdout
+    return json.loads(output.splitlines()[-1])
+
+def main() -> None:
+    arg_parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    arg_parser.add_argument('--rows', type=int, default=100000)
+    arg_parser.add_argument('--storage', default='grossbook.db',
+                            help='grossbook.db or grossbook.arrow')
+    arg_parser.add_argument('--import-budget', type=float, default=500,
+                            help='ms until run is imported and polling can start')
+    arg_parser.add_argument('--response-budget', type=float, default=1000,
+                            help='ms until the first report of a warm start')
+    args = arg_parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        make_grossbook(directory, args.rows, storage=args.storage)
+        cold = probe(directory)
+        warm = probe(directory)
+    print(f'storage {args.storage}, {args.rows} rows')
+    print(f'{"start":<6} {"import ms":>10} {"first response ms":>18}')
+    for name, result in (('cold', cold), ('warm', warm)):
+        print(f'{name:<6} {result["import_ms"]:>10.0f} {result["first_response_ms"]:>18.0f}')
+    within = (
+        warm['import_ms'] <= args.import_budget
+        and warm['first_response_ms'] <= args.response_budget
+    )
+    print(
+        f'budget import {args.import_budget:.0f} ms, '
+        f'first response {args.response_budget:.0f} ms: '
+        + ('ok' if within else 'exceeded')
+    )
+    if not within:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
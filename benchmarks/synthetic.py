@@ -0,0 +1,141 @@
+''' Synthetic grossbooks and telegram updates for benchmarks. '''
+import os
+import json
+import time
+import numpy as np
+import pandas as pd
+from storage import open_storage, CATEGORICAL
+
+COURSE = {
+    'rub': {'rub': 1, 'eur': 0.01, 'usd': 0.011},
+    'eur': {'rub': 100, 'eur': 1, 'usd': 1.1},
+    'usd': {'rub': 90, 'eur': 0.9, 'usd': 1},
+}
+
+class FakeMessage:
+    def __init__(self, text: str, chat_id: int) -> None:
+        self.text = text
+        self.chat_id = chat_id
+
+class FakeUser:
+    def __init__(self, user_id: int) -> None:
+        self.id = user_id
+
+class FakeChat:
+    def __init__(self, chat_id: int) -> None:
+        self.id = chat_id
+
+class FakeUpdate:
+    ''' the parts of telegram.Update the bot logic reads '''
+    def __init__(self, text: str = '', user_id: int = 1, chat_id: int = 1) -> None:
+        self.message = FakeMessage(text, chat_id)
+        self.effective_user = FakeUser(user_id)
+        self.effective_chat = FakeChat(chat_id)
+
+def make_update_json(update_id: int, text: str, user_id: int = 1,
+                     chat_id: int = 1) -> dict:
+    ''' a message update as telegram posts it to a webhook '''
+    return {
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id,
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private'},
+            'from': {'id': user_id, 'is_bot': False, 'first_name': f'user{user_id}'},
+            'text': text,
+        },
+    }
+
+def make_roles(count: int) -> list:
+    return [f'member{num}' for num in range(count)]
+
+def make_purposes(count: int) -> list:
+    return [f'duty{num}' for num in range(count)] + ['groceries']
+
+def make_configs(directory: str, roles: list, purposes: list, currencies: list,
+                 grossbook: str = 'grossbook.db') -> tuple:
+    ''' budget.json and telegram.json matching the generated grossbook '''
+    today = int(time.strftime('%d'))
+    budget = {
+        'course': {
+            cur_in: {cur_out: COURSE[cur_in][cur_out] for cur_out in currencies}
+            for cur_in in currencies
+        },
+        'expenses': [
+            {'purpose': purpose, 'role': roles[num % len(roles)],
+             'amount': 100 + num, 'currency': currencies[0],
+             # the first payment is due today, so the daily job has work
+             'date': (today - 1 + num) % 31 + 1}
+            for num, purpose in enumerate(purposes)
+        ],
+        'incomes': [
+            {'purpose': 'salary', 'role': role, 'amount': 5000,
+             'currency': currencies[0], 'date': 1}
+            for role in roles
+        ],
+        'pocket_money': [
+            {'purpose': 'pocket', 'role': role, 'amount': 300,
+             'currency': currencies[0], 'date': 1}
+            for role in roles
+        ],
+        # short names the message parser accepts for a category
+        'aliases': {'food': 'groceries'},
+    }
+    telegram = {
+        'token': 'benchmark',
+        'grossbook': grossbook,
+        'timezone': 'UTC',
+        'chats': [1],
+        'allowed_users': {role: num + 1 for num, role in enumerate(roles)},
+    }
+    budget_name = os.path.join(directory, 'budget.json')
+    telegram_name = os.path.join(directory, 'telegram.json')
+    with open(budget_name, 'w') as budget_file:
+        json.dump(budget, budget_file)
+    with open(telegram_name, 'w') as telegram_file:
+        json.dump(telegram, telegram_file)
+    return budget_name, telegram_name
+
+def make_frames(rows: int, roles: list, purposes: list,
+                currencies: list, years: float, seed: int = 0) -> pd.DataFrame:
+    ''' grossbook rows in the in-memory layout, spread over the last
+        years up to now, so today and this month always have entries
+    '''
+    rng = np.random.default_rng(seed)
+    now = pd.Timestamp.now().floor('min')
+    span = int(years * 365 * 24 * 60)
+    minutes = rng.integers(0, span, rows)
+    minutes[:min(rows, 10)] = 0
+    frames = pd.DataFrame({
+        'timestamp': np.sort(now - pd.to_timedelta(minutes, unit='min')),
+        'purpose': rng.choice(purposes + ['pocket_money', 'targets'], rows),
+        'role': rng.choice(roles, rows),
+        'amount': -rng.uniform(1, 200, rows).round(2),
+        'currency': rng.choice(currencies, rows),
+        'description': rng.choice(['shop', 'market', 'online order', ''], rows),
+    })
+    return frames.astype(dict.fromkeys(CATEGORICAL, 'category'))
+
+def make_grossbook(directory: str, rows: int, roles: int = 2, purposes: int = 8,
+                   currencies: tuple = ('rub', 'eur', 'usd'), years: float = 3,
+                   storage: str = 'grossbook.db', seed: int = 0) -> dict:
+    ''' write a grossbook with its configs into directory,
+        returns the paths to hand to Logic
+    '''
+    role_names = make_roles(roles)
+    purpose_names = make_purposes(purposes)
+    budget_name, telegram_name = make_configs(
+        directory, role_names, purpose_names, list(currencies), storage
+    )
+    database_name = os.path.join(directory, storage)
+    start = time.perf_counter()
+    open_storage(database_name).write(make_frames(
+        rows, role_names, purpose_names, list(currencies), years, seed
+    ))
+    return {
+        'database': database_name,
+        'telegram_config': telegram_name,
+        'budget_config': budget_name,
+        'write_seconds': time.perf_counter() - start,
+        'purposes': purpose_names,
+    }
@@ -0,0 +1,114 @@
+''' Updates per second through the webhook server, end to end.
+
+    python -m benchmarks.webhook [--updates N] [--clients N]
+        [--workers N] [--queue-size N] [--rows N] [--noop]
+
+    Clients POST recorded purchase updates to the server on localhost
+    over keep-alive connections. Every update goes through the secret
+    check, the bounded queue, the dispatcher and Logic.buy down to the
+    grossbook commit. Answers of 503 are retried, they count as
+    back-pressure. --noop replaces Logic.buy by an empty handler, which
+    leaves the cost of the server and the dispatcher alone.
+'''
+import json
+import time
+import argparse
+import tempfile
+import threading
+import http.client
+from queue import Queue
+from telegram import Bot
+from telegram.ext import Dispatcher, MessageHandler, Filters
+from busines_logic import Logic
+from webhook import WebhookServer, SECRET_HEADER
+from benchmarks.synthetic import make_grossbook, make_update_json
+
+SECRET = 'benchmark-secret'
+
+def post(connection: http.client.HTTPConnection, body: bytes, secret: str) -> int:
+    connection.request('POST', '/telegram', body, {
+        'Content-Type': 'application/json', SECRET_HEADER: secret
+    })
+    response = connection.getresponse()
+    response.read()
+    return response.status
+
+def client(port: int, bodies: list, rejected: list) -> None:
+    connection = http.client.HTTPConnection('127.0.0.1', port)
+    for body in bodies:
+        while post(connection, body, SECRET) == 503:
+            rejected.append(1)
+            time.sleep(0.01)
+    connection.close()
+
+def main() -> None:
+    arg_parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    arg_parser.add_argument('--updates', type=int, default=2000)
+    arg_parser.add_argument('--clients', type=int, default=8)
+    arg_parser.add_argument('--workers', type=int, default=8)
+    arg_parser.add_argument('--queue-size', type=int, default=256)
+    arg_parser.add_argument('--rows', type=int, default=10000)
+    arg_parser.add_argument('--noop', action='store_true')
+    args = arg_parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        paths = make_grossbook(directory, args.rows)
+        logic = Logic(
+            paths['database'], paths['telegram_config'],
+            paths['budget_config'], 'rub'
+        )
+        stored = len(logic.database.storage)
+        done = threading.Semaphore(0)
+        def buy(update, context) -> None:
+            if not args.noop:
+                assert logic.buy(update).startswith('buy ok')
+            done.release()
+
+        dispatcher = Dispatcher(Bot('123456:offline-benchmark-token'), Queue(), use_context=True)
+        dispatcher.add_handler(MessageHandler(Filters.text & ~Filters.command, buy))
+        server = WebhookServer(
+            dispatcher, SECRET, port=0,
+            queue_size=args.queue_size, workers=args.workers
+        )
+        server.start()
+        port = server.address[1]
+
+        # a wrong secret never reaches the dispatcher
+        connection = http.client.HTTPConnection('127.0.0.1', port)
+        assert post(connection, b'{}', 'wrong') == 403
+        connection.close()
+
+        bodies = [
+            json.dumps(make_update_json(num, f'#groceries\nwebhook {num}\n-1 eur')).encode()
+            for num in range(args.updates)
+        ]
+        rejected = []
+        clients = [
+            threading.Thread(
+                target=client, args=(port, bodies[num::args.clients], rejected)
+            )
+            for num in range(args.clients)
+        ]
+        start = time.perf_counter()
+        for thread in clients:
+            thread.start()
+        for thread in clients:
+            thread.join()
+        accepted = time.perf_counter() - start
+        for _ in range(args.updates):
+            done.acquire()
+        seconds = time.perf_counter() - start
+        server.stop()
+        stored = len(logic.database.storage) - stored
+        logic.close()
+
+    print(f'{args.updates} updates, {args.clients} clients, {args.workers} workers, '
+          f'queue {args.queue_size}')
+    print(f'accepted in {accepted:.2f} s, processed in {seconds:.2f} s')
+    print(f'throughput {args.updates / seconds:.0f} updates/s end to end')
+    print(f'503 back-pressure answers {len(rejected)}, stored {stored} records')
+
+if __name__ == '__main__':
+    main()
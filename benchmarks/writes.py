@@ -0,0 +1,63 @@
+''' Buys per second under bursts of concurrent purchases.
+
+    python -m benchmarks.writes [--rows N] [--burst 50] [--bursts 20]
+        [--storage grossbook.db]
+
+    Every burst starts its buys together, as the dispatcher threads
+    would, and waits for all of them. commits counts the storage
+    writes the burst took, the rest rode along in a group commit.
+'''
+import time
+import argparse
+import statistics
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from busines_logic import Logic
+from benchmarks.synthetic import make_grossbook, FakeUpdate
+
+def burst(logic: Logic, pool: ThreadPoolExecutor, size: int) -> tuple:
+    barrier = threading.Barrier(size)
+    def buy(num: int) -> str:
+        barrier.wait()
+        return logic.buy(FakeUpdate(f'#groceries\nburst {num}\n-{num + 1} eur'))
+    version = logic.database.version
+    start = time.perf_counter()
+    replies = list(pool.map(buy, range(size)))
+    seconds = time.perf_counter() - start
+    assert all(reply.startswith('buy ok') for reply in replies), replies
+    return seconds, logic.database.version - version
+
+def main() -> None:
+    arg_parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    arg_parser.add_argument('--rows', type=int, default=100000)
+    arg_parser.add_argument('--burst', type=int, default=50)
+    arg_parser.add_argument('--bursts', type=int, default=20)
+    arg_parser.add_argument('--storage', default='grossbook.db',
+                            help='grossbook.db, grossbook.arrow or grossbook')
+    args = arg_parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        paths = make_grossbook(directory, args.rows, storage=args.storage)
+        logic = Logic(
+            paths['database'], paths['telegram_config'],
+            paths['budget_config'], 'rub'
+        )
+        rows = len(logic.database.storage)
+        with ThreadPoolExecutor(args.burst) as pool:
+            burst(logic, pool, args.burst)
+            results = [burst(logic, pool, args.burst) for _ in range(args.bursts)]
+        stored = len(logic.database.storage) - rows
+        logic.close()
+    seconds = [result[0] for result in results]
+    commits = [result[1] for result in results]
+    print(f'storage {args.storage}, {args.rows} rows, {args.bursts} bursts of {args.burst} buys')
+    print(f'burst p50 {statistics.median(seconds) * 1000:.1f} ms, max {max(seconds) * 1000:.1f} ms')
+    print(f'throughput {args.burst / statistics.median(seconds):.0f} buys/s')
+    print(f'commits per burst p50 {statistics.median(commits):.0f}, max {max(commits)}')
+    print(f'stored {stored} records')
+
+if __name__ == '__main__':
+    main()
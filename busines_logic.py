@@ -1,40 +1,102 @@
 from functools import partial
 from pay_calc import PayCalc
-from database import Database
+from cache import Report, ReportCache, SingleFlight
+from config import configs
+from database import Database, parse_date
+from render import RenderPool
+from message_parser import MessageParser
+from importer import import_csv
+from metrics import metrics
 from telegram import Update
-import dataframe_image as dfi
+import numpy as np
 import pandas as pd
 import time
+import calendar
+import datetime
 import re
-import json
+
+def payments_frames(pay_calc: PayCalc, date: datetime.date,
+                    remind_days: int) -> pd.DataFrame:
+    payments = pay_calc.get_due_payments(date, remind_days)
+    if len(payments) > 0:
+        return pd.DataFrame(payments)
+    return None
+
+def payments_report(pay_calc: PayCalc, renderer: RenderPool,
+                    remind_days: int = 0) -> Report:
+    ''' payments due today and within the next remind_days,
+        read from the budget alone, the grossbook is not needed
+    '''
+    frames = payments_frames(pay_calc, datetime.date.today(), remind_days)
+    if frames is None:
+        return Report(None, None)
+    with metrics.timer('stage.render'):
+        return Report(frames, renderer.render(frames))
 
 class Logic:
     def __init__(self,
         database: str,
         telegram_config: str,
         budget_config: str, 
-        currency: str
+        currency: str,
+        renderer: str = 'table',
+        render_workers: int = 0,
+        render_pool: RenderPool = None
     ):
         self.database = Database(database)
         self.pay_calc = PayCalc(budget_config, currency)
-        self.budget_config = self.load_config(budget_config)
-        self.telegram_config = self.load_config(telegram_config)
+        self.budget_config = self.telegram_config = None
+        self.config_names = (budget_config, telegram_config)
+        configs.subscribe(budget_config, self.apply_budget)
+        configs.subscribe(telegram_config, self.apply_telegram)
         self.currency = currency
+        # 'table' draws with Pillow, 'dfi' keeps the dataframe_image export,
+        # households of one process share a single pool
+        self.renderer = render_pool or RenderPool(renderer, render_workers)
+        self.cache = ReportCache()
+        # identical reports requested together are built once
+        self.flights = SingleFlight()
 
-    def load_config(self, config: str) -> dict:
-        with open(config, 'r') as config_file:
-            return json.load(config_file)
+    def apply_budget(self, config: dict) -> None:
+        # a config the parser rejects leaves everything as it was
+        self._build_parser(config, self.telegram_config)
+        self.budget_config = config
+
+    def apply_telegram(self, config: dict) -> None:
+        self._build_parser(self.budget_config, config)
+        self.telegram_config = config
+
+    def close(self) -> None:
+        ''' release the grossbook and stop following the configs,
+            the render pool may be shared and is left running
+        '''
+        budget_config, telegram_config = self.config_names
+        configs.unsubscribe(budget_config, self.apply_budget)
+        configs.unsubscribe(telegram_config, self.apply_telegram)
+        self.pay_calc.close()
+        self.database.close()
 
 
     def buy(self, update: Update) -> str:
-        record, status = self._make_record(update)
-        if record is not None:
-            self.database.add_record(record)
+        records, status = self._make_records(update)
+        if records is not None:
+            # the writer thread commits it together with concurrent buys
+            self.database.submit(records).result()
+            if len(records) > 1:
+                status = f'{len(records)} entries {status}'
             reply = f'buy {status} 👌\n'
         else:
             reply = f'buy error 🚫:\n' + status
         return reply
 
+    def import_csv(self, update: Update, text: str) -> str:
+        ''' back-fill the grossbook from an uploaded csv,
+            rows without a role are booked on the sender
+        '''
+        role = self.parser.roles[update.effective_user.id]
+        result = import_csv(self.database, self.parser, text, role)
+        return result.summary()
+
     def get_expenses(self, update: Update) -> str:
         expenses = self._get_raw_expenses()
         expenses = list(map(str.lower, expenses))
@@ -43,122 +105,222 @@ class Logic:
         reply = '\n'.join(expenses)
         return reply
 
-    def get_expenses_stats(self, update: Update) -> bool:
+    def get_expenses_stats(self, update: Update) -> Report:
         ''' compute how much family members spent
         on duties this month and who originally should 
         pay for it. As well as how much left to pay.
         '''
         today_date = time.strftime('%d.%m.%Y')
-        status, frames = self.database.get_duty_entries(today_date)
-        frames['currency'] = frames['currency'].apply(
-            self.pay_calc.convert_currency_name
+        return self._report(
+            ('expenses_stats', today_date[3:], self.currency),
+            partial(self._expenses_stats_frames, today_date)
         )
-        converter = partial(
-            self.pay_calc.convert_currency,
-            self.currency
-        )
-        #conver everything to default currency
-        frames = frames.apply(converter, axis=1)
-        frames = frames.groupby('purpose').sum()
-
-        # duties accordint the initial plan
-        expenses = pd.DataFrame(self.pay_calc.config['expenses'])
-        expenses = expenses[['purpose', 'amount', 'currency']]
-        expenses = expenses.apply(converter, axis=1)
-        expenses = expenses.groupby('purpose').sum()
-
-        #substract frame amounts from incomes
-        for purp in expenses.index.tolist():
-            if purp in frames.index:
-                expenses.loc[purp, 'amount'] += frames.loc[purp, 'amount']
-
-        #export to debt png
-        if len(expenses) > 0:
-            dfi.export(expenses, 'expenses_stats.png')
 
-        return status
+    def get_month_stats(self, update: Update, period: str = None) -> Report:
+        ''' statistics of a 'mm.yyyy' month, the current one by default,
+            None when the period cannot be parsed
+        '''
+        period = period or time.strftime('%m.%Y')
+        if not re.fullmatch(r'\d{2}\.\d{4}', period):
+            return None
+        month, year = map(int, period.split('.'))
+        if not 1 <= month <= 12:
+            return None
+        last_day = calendar.monthrange(year, month)[1]
+        return self.get_range_stats(update, f'01.{period}', f'{last_day}.{period}')
 
-    def get_month_stats(self, update: Update) -> bool:
-        reply = 'month stats'
-        return reply
+    def get_range_stats(self, update: Update, first: str, last: str) -> Report:
+        ''' spendings per purpose and role between two
+            'dd.mm.yyyy' days inclusive, in the default currency,
+            None when the days cannot be parsed
+        '''
+        try:
+            first_day = time.strptime(first, '%d.%m.%Y')
+            last_day = time.strptime(last, '%d.%m.%Y')
+        except ValueError:
+            return None
+        if first_day > last_day:
+            return None
+        return self._report(
+            ('range_stats', f'{first}-{last}', self.currency),
+            partial(self._range_stats_frames, first, last)
+        )
 
-    def dayly_job(self) -> list:
-        month_day = int(time.strftime('%d'))
-        payments = self.pay_calc.get_today_payments(month_day)
-        if len(payments) > 0:
-            dfi.export(pd.DataFrame(payments), 'payments.png')
-        return len(payments) > 0
+    def rebuild_aggregates(self, update: Update) -> str:
+        if self.database.rebuild_aggregates():
+            return 'aggregates consistent 👌'
+        return 'aggregates drifted, rebuilt from history 🔧'
 
-    def get_day_stats(self, update: Update) -> bool:
+    def dayly_job(self, remind_days: int = 0) -> Report:
+        ''' payments due today and within the next remind_days '''
         today_date = time.strftime('%d.%m.%Y')
-        status, frames = self.database.get_day_stats(today_date)
-        print(frames)
-        if len(frames) > 0:
-            dfi.export(frames, 'daystats.png')
-            status = True
-        return status
+        return self._report(
+            ('payments', today_date, remind_days),
+            partial(self._payments_frames, datetime.date.today(), remind_days)
+        )
 
-    def get_pocket_summary(self, update: Update, currency: str) -> bool:
+    def get_day_stats(self, update: Update) -> Report:
         today_date = time.strftime('%d.%m.%Y')
-        status, frames = self.database.get_pocket_summary(today_date)
-        frames['currency'] = frames['currency'].apply(
-            self.pay_calc.convert_currency_name
+        return self._report(
+            ('day_stats', today_date, None),
+            partial(self._day_stats_frames, today_date)
         )
-        converter = partial(
-            self.pay_calc.convert_currency,
-            currency
+
+    def get_pocket_summary(self, update: Update, currency: str) -> Report:
+        today_date = time.strftime('%d.%m.%Y')
+        return self._report(
+            ('pocket_summary', today_date[3:], currency),
+            partial(self._pocket_summary_frames, today_date, currency)
         )
-        frames = frames.apply(converter, axis=1)
-        frames = frames.groupby('role').sum()
-        if len(frames) > 0:
-            dfi.export(frames, 'pocket_summary.png')
-            status=True
-        return status
 
     def get_groceries_summary(self, update: Update, currency: str) -> str:
         today_date = time.strftime('%d.%m.%Y')
         status, frames = self.database.get_groceries_summary(today_date)
-        frames['currency'] = frames['currency'].apply(
-            self.pay_calc.convert_currency_name
-        )
-        converter = partial(
-            self.pay_calc.convert_currency,
-            currency
-        )
-        frames = frames.apply(converter, axis=1)
-        groceries_sum = frames['amount'].sum()
+        frames = self.pay_calc.convert_frame(frames, currency)
+        with metrics.timer('stage.aggregate'):
+            groceries_sum = frames['amount'].sum()
         return status, str(groceries_sum)
 
-    def get_debt_summary(self, update: Update) -> bool:
+    def get_forecast(self, update: Update, months: int = 6) -> Report:
+        ''' planned and spent duties and the running debt of every
+            role, for the last months and a forecast of the next ones
+        '''
+        today_date = time.strftime('%d.%m.%Y')
+        return self._report(
+            ('forecast', today_date[3:], months, self.currency),
+            partial(self._forecast_frames, today_date, months)
+        )
+
+    def get_debt_summary(self, update: Update) -> Report:
         ''' Everything earned, except pocket money, 
             and what is spent on duties, should be counted as debt.
         '''
         today_date = time.strftime('%d.%m.%Y')
-        status, frames = self.database.get_duty_entries(today_date)
-        frames['currency'] = frames['currency'].apply(
-            self.pay_calc.convert_currency_name
+        return self._report(
+            ('debt_summary', today_date[3:], self.currency),
+            partial(self._debt_summary_frames, today_date)
         )
-        converter = partial(
-            self.pay_calc.convert_currency,
-            self.currency
+
+
+# private section
+
+    @metrics.timed('stage.render')
+    def _render(self, frames: pd.DataFrame) -> bytes:
+        # every request renders into its own buffer, nothing touches the disk
+        return self.renderer.render(frames)
+
+    def _report(self, key: tuple, build) -> Report:
+        ''' serve a report from the cache while neither the
+            grossbook nor the budget changed, build it otherwise
+        '''
+        key = key + (self.database.version, self.pay_calc.version)
+        report = self.cache.get(key)
+        if report is None:
+            report = self.flights.do(key, partial(self._build_report, key, build))
+        return report
+
+    def _build_report(self, key: tuple, build) -> Report:
+        # a flight that just finished may have cached it already
+        report = self.cache.get(key)
+        if report is None:
+            frames = build()
+            image = None if frames is None else self._render(frames)
+            report = Report(frames, image)
+            self.cache.put(key, report)
+        return report
+
+    def _projection(self, today_date: str, whole_history: bool = False,
+                    forecast: int = 0):
+        ''' the budget projected over this month of the grossbook,
+            or over all of it, up to today and forecast months on
+        '''
+        date = parse_date(today_date)
+        current = (date.year, date.month)
+        history = self.database.get_history_totals(
+            None if whole_history else current, current
         )
-        #conver everything to default currency
-        frames = frames.apply(converter, axis=1)
-        frames = frames.groupby('role').sum()
-        incomes = self.pay_calc.get_incomes()
-        pocket_money = self.pay_calc.get_pocket_money()
-        #substract frame amounts from incomes
-        for role in frames.index:
-            frames.loc[role, 'amount'] += incomes[role] - pocket_money[role]
-
-        #export to debt png
-        if len(frames) > 0:
-            dfi.export(frames, 'debt_summary.png')
+        first = min(history, default=current)
+        return self.pay_calc.project(history, first, current, forecast)
 
-        return status
+    def _expenses_stats_frames(self, today_date: str) -> pd.DataFrame:
+        projection = self._projection(today_date)
+        month = projection.current
+        # duties according to the plan, less what is spent on them
+        purposes, left = projection.left(month)
+        expenses = pd.DataFrame(
+            {'amount': left}, index=pd.Index(purposes, name='purpose')
+        ).sort_index()
+        if projection.duties_booked(month).any() and len(expenses) > 0:
+            return expenses
+        return None
 
+    def _range_stats_frames(self, first: str, last: str) -> pd.DataFrame:
+        totals = self.database.get_range_totals(first, last)
+        with metrics.timer('stage.aggregate'):
+            # one pass over the totals, converted while summing
+            table = {}
+            for (role, purpose, currency), amount in totals.items():
+                row = table.setdefault(purpose, {})
+                row[role] = row.get(role, 0.0) + self.pay_calc.convert_amount(
+                    amount, currency, self.currency
+                )
+            if not table:
+                return None
+            frames = pd.DataFrame.from_dict(table, orient='index').fillna(0.0)
+            frames = frames.sort_index()[sorted(frames.columns)]
+            frames['total'] = frames.sum(axis=1)
+            frames.loc['total'] = frames.sum()
+            frames.index.name = 'purpose'
+        return frames
 
-# private section
+    def _payments_frames(self, date: datetime.date, remind_days: int) -> pd.DataFrame:
+        return payments_frames(self.pay_calc, date, remind_days)
+
+    def _day_stats_frames(self, today_date: str) -> pd.DataFrame:
+        status, frames = self.database.get_day_stats(today_date)
+        if status:
+            return frames
+        return None
+
+    def _pocket_summary_frames(self, today_date: str, currency: str) -> pd.DataFrame:
+        status, frames = self.database.get_pocket_summary(today_date)
+        frames = self.pay_calc.convert_frame(frames, currency)
+        with metrics.timer('stage.aggregate'):
+            frames = frames.groupby('role')[['amount']].sum()
+        if len(frames) > 0:
+            return frames
+        return None
+
+    def _debt_summary_frames(self, today_date: str) -> pd.DataFrame:
+        projection = self._projection(today_date)
+        month = projection.current
+        # roles that booked duties this month
+        booked = projection.duties_booked(month)
+        if not booked.any():
+            return None
+        return pd.DataFrame(
+            {'amount': projection.debt[booked, month]},
+            index=pd.Index(np.array(projection.roles)[booked], name='role')
+        ).sort_index()
+
+    def _forecast_frames(self, today_date: str, months: int) -> pd.DataFrame:
+        projection = self._projection(today_date, whole_history=True, forecast=months)
+        # the two months before the current one, for comparison
+        shown = slice(max(0, projection.current - 2), None)
+        frames = pd.DataFrame(
+            projection.running[:, shown].T, columns=projection.roles
+        )
+        frames = frames[sorted(frames.columns)]
+        frames['debt'] = frames.sum(axis=1)
+        frames.insert(
+            0, 'planned', -projection.planned[:, projection.duties].sum()
+        )
+        frames.insert(1, 'spent', projection.spent[:, shown].sum(axis=0))
+        frames.index = pd.Index([
+            f'{month:02}.{year}' + (' *' if num > projection.current else '')
+            for num, (year, month) in enumerate(projection.months)
+        ][shown], name='month')
+        return frames
 
     def _get_raw_expenses(self) -> dict:
         expenses = dict(map(
@@ -167,60 +329,16 @@ class Logic:
         ))
         return expenses
 
-    def _get_username_by_id(self, id: int) -> str:
-        users = self.telegram_config['allowed_users']
-        reverse_config = dict(
-            zip(users.values(), users.keys())
-        )
-        return reverse_config[id]
-
-    def _make_record(self, update: Update):
-        lines = list(map(str.strip, update.message.text.split('\n')))
-        len_ok = len(lines) >= 2
-        if not len_ok:
-            return ( None, 
-                'wrong message format\n'
-                'should be:\n'
-                '#purpose\n'
-                'description\n'
-                '+-amount'
-            )
-        # everything except the leading # symbol
-        category = lines[0][lines[0].index('#')+1:].lower()
-        all_categories = list(map(
-            str.lower, 
-            self._get_raw_expenses()
-        ))
-        all_categories.append('pocket_money')
-        all_categories.append('targets')
-        category_ok = category in all_categories
-        if not category_ok:
-            return ( None, 
-                'category unrecognized\n'
-                'see \\help\n'
-            )
-        amount_ok = re.match(
-            r'([+-]?([0-9]|\.)+)[\ ]*([$€₽]|rub|eur|usd|EUR|USD|RUB)', 
-            lines[-1]
-        )
-        if not amount_ok:
-            return ( None,
-                'amount unrecognized\n'
-                'should be a number followed by a currency symbol'
-            )
-        if len_ok and category_ok and amount_ok:
-            # get currency in well known format
-            rec_currency = self.pay_calc.convert_currency_name(amount_ok.group(3))
+    def _build_parser(self, budget_config: dict, telegram_config: dict) -> None:
+        if budget_config is not None and telegram_config is not None:
+            self.parser = MessageParser(budget_config, telegram_config)
+
+    def _make_records(self, update: Update):
+        return self.parser.parse(
+            update.message.text,
+            update.effective_user.id,
             # current date: 'dd.mm.yyyy'
-            msg_date = time.strftime('%d.%m.%Y')
+            time.strftime('%d.%m.%Y'),
             # current time 'hh:mm':
-            msg_time = time.strftime('%H:%M')
-            return ({
-                'date': msg_date,
-                'time': msg_time,
-                'purpose': category,
-                'role': self._get_username_by_id(update.effective_user.id),
-                'amount': float(amount_ok.group(1)),
-                'currency': rec_currency,
-                'description': '\n'.join(lines[1:-1]).replace(',', '.')
-            }, 'ok')
\ No newline at end of file
+            time.strftime('%H:%M')
+        )
@@ -0,0 +1,90 @@
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+
+class Report:
+    ''' Computed report frames with their rendered image.
+        Once the photo is uploaded, its telegram file_id is kept
+        so repeated requests send the id instead of the bytes.
+    '''
+    def __init__(self, frames: 'pandas.DataFrame', image: bytes) -> None:
+        self.frames = frames
+        self.image = image
+        self.file_id = None
+
+    def __bool__(self) -> bool:
+        return self.image is not None
+
+    def photo(self):
+        return self.file_id or self.image
+
+    def size(self) -> int:
+        frames_size = 0
+        if self.frames is not None:
+            frames_size = int(self.frames.memory_usage(deep=True).sum())
+        return frames_size + len(self.image or b'')
+
+class ReportCache:
+    ''' LRU of reports bounded by entry count and total size.
+        Keys carry the data versions, so stale entries are
+        never hit and simply age out.
+    '''
+    def __init__(self, max_entries: int = 64, max_bytes: int = 32 * 2**20) -> None:
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+        self.lock = threading.Lock()
+
+    def get(self, key: tuple) -> Report:
+        with self.lock:
+            report = self.entries.get(key)
+            if report is not None:
+                self.entries.move_to_end(key)
+            return report
+
+    def put(self, key: tuple, report: Report) -> None:
+        with self.lock:
+            if key in self.entries:
+                self.total_bytes -= self.entries.pop(key).size()
+            self.entries[key] = report
+            self.total_bytes += report.size()
+            while self.entries and (
+                len(self.entries) > self.max_entries
+                or self.total_bytes > self.max_bytes
+            ):
+                _, evicted = self.entries.popitem(last=False)
+                self.total_bytes -= evicted.size()
+
+    def clear(self) -> None:
+        with self.lock:
+            self.entries.clear()
+            self.total_bytes = 0
+
+class SingleFlight:
+    ''' Concurrent calls with the same key share one computation:
+        the first caller runs it, the others wait for its result.
+    '''
+    def __init__(self) -> None:
+        self.calls = {}
+        self.lock = threading.Lock()
+
+    def do(self, key: tuple, func):
+        with self.lock:
+            future = self.calls.get(key)
+            leader = future is None
+            if leader:
+                future = self.calls[key] = Future()
+        if not leader:
+            return future.result()
+        try:
+            result = func()
+        except BaseException as error:
+            future.set_exception(error)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self.lock:
+                del self.calls[key]
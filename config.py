@@ -0,0 +1,106 @@
+import os
+import json
+import logging
+import threading
+from collections import defaultdict
+
+logger = logging.getLogger(__name__)
+
+class ConfigService:
+    ''' Shared json configs, parsed once per change.
+        poll() compares mtimes, reparses only the files that changed
+        and hands the new dict to every subscriber, which swaps its
+        derived structures in one assignment. A version that any
+        subscriber rejects by raising is not kept.
+    '''
+    def __init__(self) -> None:
+        self.configs = {}
+        self.mtimes = {}
+        # mtimes of versions a listener refused
+        self.rejected = {}
+        self.listeners = defaultdict(list)
+        self.lock = threading.RLock()
+
+    def load(self, config_name: str) -> dict:
+        with self.lock:
+            if config_name not in self.configs:
+                self._read(config_name)
+            return self.configs[config_name]
+
+    def subscribe(self, config_name: str, listener) -> None:
+        ''' listener is called now and after every change '''
+        with self.lock:
+            self.listeners[config_name].append(listener)
+            listener(self.load(config_name))
+
+    def unsubscribe(self, config_name: str, listener) -> None:
+        ''' the parsed config is dropped with its last listener '''
+        with self.lock:
+            self.listeners[config_name].remove(listener)
+            if not self.listeners[config_name]:
+                del self.listeners[config_name]
+                self.configs.pop(config_name, None)
+                self.mtimes.pop(config_name, None)
+                self.rejected.pop(config_name, None)
+
+    def store(self, config_name: str, config: dict) -> None:
+        ''' write a config back without triggering a reload '''
+        with self.lock:
+            with open(config_name, 'w') as config_file:
+                json.dump(config, config_file, indent=4)
+            self.configs[config_name] = config
+            self.mtimes[config_name] = os.path.getmtime(config_name)
+
+    def poll(self, config_names: list = None) -> list:
+        ''' reload changed files, returns their names '''
+        changed = []
+        with self.lock:
+            for config_name in config_names or list(self.configs):
+                try:
+                    mtime = os.path.getmtime(config_name)
+                except FileNotFoundError:
+                    # an editor saving by rename, the file is back soon
+                    continue
+                if mtime in (self.mtimes.get(config_name), self.rejected.get(config_name)):
+                    continue
+                try:
+                    with open(config_name, 'r') as config_file:
+                        config = json.load(config_file)
+                except (OSError, ValueError) as error:
+                    # keep serving the last good version
+                    logger.warning('could not reload %s: %s', config_name, error)
+                    continue
+                if not self._apply(config_name, config):
+                    # tried again once the file changes
+                    self.rejected[config_name] = mtime
+                    continue
+                self.configs[config_name] = config
+                self.mtimes[config_name] = mtime
+                self.rejected.pop(config_name, None)
+                changed.append(config_name)
+        return changed
+
+    def _apply(self, config_name: str, config: dict) -> bool:
+        ''' hand a new config to every listener; when one rejects it,
+            those that took it already get the last good version back
+        '''
+        applied = []
+        for listener in self.listeners[config_name]:
+            try:
+                listener(config)
+            except Exception:
+                logger.exception('could not apply %s, keeping the last good version', config_name)
+                for accepted in applied:
+                    accepted(self.configs[config_name])
+                return False
+            applied.append(listener)
+        return True
+
+    def _read(self, config_name: str) -> None:
+        mtime = os.path.getmtime(config_name)
+        with open(config_name, 'r') as config_file:
+            self.configs[config_name] = json.load(config_file)
+        self.mtimes[config_name] = mtime
+
+# one instance per process, shared by everything reading configs
+configs = ConfigService()
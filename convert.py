@@ -0,0 +1,44 @@
+''' Convert the grossbook between storage formats.
+
+    python convert.py grossbook.csv grossbook.arrow
+    python convert.py grossbook.db grossbook.arrow
+    python convert.py grossbook.arrow grossbook.csv
+    python convert.py grossbook.db grossbook
+
+    The format follows the extension: .csv, .arrow/.feather, a
+    directory of month partitions without one, or sqlite otherwise. The target must not hold records yet.
+    The bot reads the grossbook named by the "grossbook" key of
+    telegram.json, grossbook.db by default; point it at the target
+    while the bot is stopped.
+'''
+import os
+import sys
+import argparse
+from storage import open_storage, read_csv, write_csv
+
+def is_csv(file_name: str) -> bool:
+    return os.path.splitext(file_name)[1] == '.csv'
+
+def main() -> None:
+    arg_parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    arg_parser.add_argument('source')
+    arg_parser.add_argument('target')
+    args = arg_parser.parse_args()
+
+    if is_csv(args.source):
+        frames = read_csv(args.source)
+    else:
+        frames = open_storage(args.source).load()
+    if is_csv(args.target):
+        write_csv(frames, args.target)
+    else:
+        target = open_storage(args.target)
+        if len(target) > 0:
+            sys.exit(f'{args.target} is not empty')
+        target.write(frames)
+    print(f'{len(frames)} records: {args.source} -> {args.target}')
+
+if __name__ == '__main__':
+    main()
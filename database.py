@@ -1,66 +1,464 @@
+import os
+import queue
+import pickle
+import threading
 import pandas as pd
-from functools import partial
-from collections import namedtuple
+from collections import namedtuple, OrderedDict
+from concurrent.futures import Future
+from storage import (
+    open_storage, to_frame, concat_frames,
+    COLUMNS, DATE_FORMAT, TIME_FORMAT
+)
+from aggregates import MonthlyAggregates, totals_frame
+from metrics import metrics
 
 Date = namedtuple('Date', ['day', 'month', 'year'])
 
+def parse_date(date: str) -> Date:
+    return Date(*map(int, date.split('.')))
+
+# bumped whenever the layout of the warm state changes
+WARM_FORMAT = 1
+
+# a consistent view of the eager grossbook: the frame sorted by
+# timestamp and (year, month) -> [start, stop) row ranges into it
+Snapshot = namedtuple('Snapshot', ['data', 'months'])
+
 class Database:
-    def __init__(self, file_name):
+    def __init__(self, file_name, resident_months=3, max_batch=1000):
         self.file_name = file_name
-        self.data = pd.read_csv(self.file_name)
+        # guards the in-memory state, held briefly by the writer
+        self.lock = threading.Lock()
+        # bumped on every change, report caches key on it
+        self.version = 0
+        # grossbook.db is sqlite, grossbook.arrow the columnar format,
+        # grossbook/ a directory of month partitions
+        self.storage = open_storage(file_name)
+        # seeded once from the legacy grossbook.csv
+        self.storage.migrate_csv(os.path.splitext(file_name)[0] + '.csv')
+        self.aggregates = MonthlyAggregates()
+        self.lazy = self.storage.partitioned
+        if self.lazy:
+            # only recently used months stay in memory,
+            # their totals are built on first use
+            self.partitions = OrderedDict()
+            self.resident_months = resident_months
+        elif not self._load_warm():
+            # taken before reading, rows written meanwhile only
+            # make it stale, never hidden
+            self.signature = self.storage.signature()
+            with metrics.timer('stage.load'):
+                self.snapshot = self._index(self.storage.load())
+            self.aggregates.totals = self.aggregates.rebuild(self.snapshot.data)
+        # writes are queued for a single writer thread, which commits
+        # everything pending in one storage write
+        self.pending = queue.Queue()
+        self.max_batch = max_batch
+        self.writer = None
+        self.writer_lock = threading.Lock()
+        # (version, batch totals) of the commits during a rebuild
+        self.commits = None
+        self.rebuild_lock = threading.Lock()
+
+    @property
+    def data(self):
+        return self.snapshot.data
+
+    def close(self):
+        with self.writer_lock:
+            if self.writer is not None:
+                self.pending.put(None)
+                self.writer.join()
+                self.writer = None
+        if self.lazy:
+            self.storage.close()
+            return
+        # rows written by another process are not in the snapshot,
+        # then it must not be saved as matching the storage
+        unchanged = (
+            self.signature is not None
+            and self.storage.signature() == self.signature
+        )
+        if unchanged:
+            # the snapshot already holds every row, compaction only
+            # moves them; the warm state takes the signature after it
+            self.storage.tidy()
+        self.storage.close()
+        if unchanged:
+            self._save_warm()
+
+    def _warm_name(self):
+        return self.file_name + '.warm'
+
+    def _load_warm(self):
+        ''' the sorted grossbook, its month index and totals as they
+            were at the last close, if the storage is unchanged since
+        '''
+        signature = self.storage.signature()
+        if signature is None:
+            return False
+        try:
+            with metrics.timer('stage.load'), open(self._warm_name(), 'rb') as warm_file:
+                warm = pickle.load(warm_file)
+        except Exception:
+            # missing, truncated or foreign, either way a cold load
+            return False
+        if warm.get('format') != WARM_FORMAT or warm.get('signature') != signature:
+            return False
+        self.snapshot = warm['snapshot']
+        self.aggregates.totals = warm['totals']
+        self.signature = signature
+        return True
+
+    def _save_warm(self):
+        # closing may have changed the files, e.g. a sqlite checkpoint
+        signature = self.storage.signature()
+        if signature is None:
+            return
+        warm = {
+            'format': WARM_FORMAT,
+            'signature': signature,
+            'snapshot': self.snapshot,
+            'totals': self.aggregates.totals,
+        }
+        temp_name = self._warm_name() + '.tmp'
+        with open(temp_name, 'wb') as warm_file:
+            pickle.dump(warm, warm_file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temp_name, self._warm_name())
+
+    def submit(self, records):
+        ''' queue records for the writer, the future resolves once
+            they are durable and visible to readers
+        '''
+        future = Future()
+        with self.writer_lock:
+            if self.writer is None:
+                self.writer = threading.Thread(
+                    target=self._write_loop, name='grossbook-writer', daemon=True
+                )
+                self.writer.start()
+            self.pending.put((records, future))
+        return future
 
     def add_record(self, record):
-        self.data = self.data.append(record, ignore_index=True)
-        self.data.to_csv(self.file_name, index=False)
+        self.submit([record]).result()
+
+    def add_records(self, records):
+        ''' store a batch of records in one transaction '''
+        if records:
+            self.submit(records).result()
+
+    def _write_loop(self):
+        while True:
+            item = self.pending.get()
+            if item is None:
+                return
+            batch = [item]
+            # group commit: whatever queued up meanwhile joins this write
+            while len(batch) < self.max_batch:
+                try:
+                    item = self.pending.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    # finish this batch, then stop
+                    self.pending.put(None)
+                    break
+                batch.append(item)
+            try:
+                self._commit([rec for records, _ in batch for rec in records])
+            except Exception as error:
+                for _, future in batch:
+                    future.set_exception(error)
+            else:
+                for _, future in batch:
+                    future.set_result(None)
+
+    def _commit(self, records):
+        frames = to_frame(pd.DataFrame(records, columns=COLUMNS))
+        totals = self.aggregates.rebuild(frames)
+        if self.lazy:
+            # partitions are reread from disk, so rows on disk and in
+            # the resident totals change together
+            with self.lock, metrics.timer('stage.write'):
+                self.storage.append(records)
+                stamps = frames['timestamp']
+                for (year, month), month_frames in frames.groupby(
+                    [stamps.dt.year, stamps.dt.month]
+                ):
+                    self._append_partition((year, month), month_frames)
+                # unbuilt months are read complete from the partition later
+                self.aggregates.merge({
+                    month: month_totals for month, month_totals in totals.items()
+                    if month in self.aggregates.totals
+                })
+                self.version += 1
+                self._note_commit(totals)
+            return
+        with metrics.timer('stage.write'):
+            before = self.storage.signature()
+            self.storage.append(records)
+            after = self.storage.signature()
+        # only this thread replaces the snapshot, readers keep the old one
+        snapshot = self._extend(self.snapshot, frames)
+        with self.lock:
+            # someone else wrote since our last commit, the snapshot
+            # lacks their rows and no signature describes it any more
+            self.signature = after if before == self.signature else None
+            self.snapshot = snapshot
+            self.aggregates.merge(totals)
+            self.version += 1
+            self._note_commit(totals)
+
+    def _note_commit(self, totals):
+        # a running rebuild adds what its scan may have missed
+        if self.commits is not None:
+            self.commits.append((self.version, totals))
+
+    def rebuild_aggregates(self):
+        ''' recompute monthly totals from the whole history,
+            returns whether the running totals were consistent.
+            The history is read without the lock, commits go on and
+            are added to the months the scan read before them.
+        '''
+        with self.rebuild_lock:
+            with self.lock:
+                self.commits = []
+                version = self.version
+                snapshot = None if self.lazy else self.snapshot
+            try:
+                if self.lazy:
+                    # one partition at a time, the resident set is untouched
+                    scanned = {
+                        key: self._scan_month(*key) for key in self.storage.months()
+                    }
+                else:
+                    scanned = {
+                        key: (version, month_totals) for key, month_totals
+                        in self.aggregates.rebuild(snapshot.data).items()
+                    }
+                with self.lock:
+                    rebuilt = MonthlyAggregates()
+                    rebuilt.totals = {
+                        key: month_totals for key, (_, month_totals) in scanned.items()
+                    }
+                    for committed, batch in self.commits:
+                        rebuilt.merge({
+                            key: month_totals for key, month_totals in batch.items()
+                            if committed > scanned.get(key, (version,))[0]
+                        })
+                    if self.lazy:
+                        built = {
+                            month: rebuilt.totals.get(month, {})
+                            for month in self.aggregates.totals
+                        }
+                        consistent = self.aggregates.is_consistent(built)
+                    else:
+                        consistent = self.aggregates.is_consistent(rebuilt.totals)
+                    self.aggregates.totals = rebuilt.totals
+                    self.version += 1
+            finally:
+                with self.lock:
+                    self.commits = None
+        return consistent
+
+    def _scan_month(self, year, month):
+        ''' (version, totals) of a stored month, the totals hold
+            exactly the commits up to that version
+        '''
+        key = (year, month)
+        with self.lock:
+            version = self.version
+            frames = self.partitions.get(key)
+        if frames is None:
+            frames = self.storage.load_month(year, month)
+        totals = self.aggregates.rebuild(frames).get(key, {})
+        with self.lock:
+            if not any(
+                committed > version and key in batch
+                for committed, batch in self.commits
+            ):
+                return version, totals
+            # written while it was read, read again under the lock
+            frames = self.partitions.get(key)
+            if frames is None:
+                frames = self.storage.load_month(year, month)
+            return self.version, self.aggregates.rebuild(frames).get(key, {})
+
+    def _index(self, data):
+        ''' sort the frame by timestamp and map every
+            (year, month) to its [start, stop) row range
+        '''
+        data = data.sort_values('timestamp', kind='stable').reset_index(drop=True)
+        return Snapshot(data, self._month_ranges(data['timestamp'], 0, {}))
+
+    def _month_ranges(self, stamps, offset, months):
+        keys = stamps.dt.year * 12 + stamps.dt.month - 1
+        for key, rows in keys.groupby(keys).indices.items():
+            year, month = divmod(int(key), 12)
+            start, stop = int(rows[0]) + offset, int(rows[-1]) + offset + 1
+            if (year, month + 1) in months:
+                start = months[year, month + 1][0]
+            months[year, month + 1] = (start, stop)
+        return months
+
+    def _extend(self, snapshot, frames):
+        ''' a new snapshot with frames appended '''
+        data = concat_frames(snapshot.data, frames)
+        stamps = frames['timestamp']
+        if not stamps.is_monotonic_increasing or (
+            len(snapshot.data) > 0
+            and stamps.iat[0] < snapshot.data['timestamp'].iat[-1]
+        ):
+            # back-filled history or a clock that went backwards
+            return self._index(data)
+        months = self._month_ranges(stamps, len(snapshot.data), dict(snapshot.months))
+        return Snapshot(data, months)
+
+    def _partition(self, year, month, resident=True):
+        ''' month frame from the LRU of resident partitions, a month
+            read from disk joins it unless resident is False; months
+            without records are never made resident
+        '''
+        key = (year, month)
+        with self.lock:
+            if key in self.partitions:
+                self.partitions.move_to_end(key)
+                return self.partitions[key]
+            version = self.version
+        if not self.storage.has_month(year, month):
+            return to_frame(pd.DataFrame(columns=COLUMNS))
+        # read without the lock, the writer goes on meanwhile
+        with metrics.timer('stage.load'):
+            frames = self.storage.load_month(year, month).sort_values(
+                'timestamp', kind='stable'
+            ).reset_index(drop=True)
+        with self.lock:
+            # after a commit in between the frame may lack its rows,
+            # it serves this read only
+            if resident and self.version == version and key not in self.partitions:
+                self.partitions[key] = frames
+                while len(self.partitions) > self.resident_months:
+                    self.partitions.popitem(last=False)
+        return frames
+
+    def _append_partition(self, key, frames):
+        # the storage already has the rows, only resident months change
+        if key in self.partitions:
+            self.partitions[key] = concat_frames(
+                self.partitions[key], frames
+            ).sort_values('timestamp', kind='stable').reset_index(drop=True)
+
+    def _month_frame(self, year, month):
+        if self.lazy:
+            return self._partition(year, month)
+        snapshot = self.snapshot
+        start, stop = snapshot.months.get((year, month), (0, 0))
+        return snapshot.data.iloc[start:stop]
 
+    def _display(self, frames):
+        # date and time strings are only formatted for shown rows
+        stamps = frames['timestamp']
+        return frames.assign(
+            date=stamps.dt.strftime(DATE_FORMAT),
+            time=stamps.dt.strftime(TIME_FORMAT)
+        )[['date', 'time', 'purpose', 'amount', 'currency', 'description']]
+
+    @metrics.timed('stage.filter')
     def get_day_stats(self, day):
-        frames = self.data.loc[
-            self.data['date']==day, 
-            ['date', 'time', 'purpose', 'amount', 'currency', 'description']
-        ]
+        date = parse_date(day)
+        frames = self._month_frame(date.year, date.month)
+        begin = pd.Timestamp(date.year, date.month, date.day)
+        start, stop = frames['timestamp'].searchsorted(
+            [begin, begin + pd.Timedelta(days=1)]
+        )
+        frames = self._display(frames.iloc[start:stop])
         status = len(frames) > 0
         return status, frames
 
-    def is_same_month(self, date1, date2):
-        return date1.month == date2.month and date1.year == date2.year
+    def _month_totals(self, year, month):
+        ''' copy of a month's running totals, built on first use '''
+        key = (year, month)
+        while True:
+            with self.lock:
+                if not self.lazy or key in self.aggregates.totals:
+                    return dict(self.aggregates.totals.get(key, {}))
+                version = self.version
+            if not self.storage.has_month(year, month):
+                return {}
+            # history scans leave the resident months alone
+            totals = self.aggregates.rebuild(
+                self._partition(year, month, resident=False)
+            )
+            with self.lock:
+                # a commit in between skipped this unbuilt month, build again
+                if self.version == version:
+                    self.aggregates.merge(totals)
+                    self.aggregates.totals.setdefault(key, {})
+                    return dict(self.aggregates.totals[key])
 
-    def get_month_entries(self, date):
-        today_date = Date(*date.split('.'))
-        dates = self.data['date'].apply(lambda date: Date(*date.split('.')))
-        cur_month = partial(self.is_same_month, today_date)
-        frames = self.data.loc[
-            dates.apply(cur_month),
+    def _stored_months(self, first=None, last=None):
+        ''' sorted (year, month) holding records, first to last inclusive '''
+        if self.lazy:
+            months = self.storage.months()
+        else:
+            with self.lock:
+                months = sorted(self.aggregates.totals)
+        return [
+            key for key in months
+            if (first is None or key >= first) and (last is None or key <= last)
         ]
-        return frames
 
-    def get_month_stats(self, date):
-        today_date = Date(*date.split('.'))
-        cur_month = partial(self.is_same_month, today_date)
-        frames = self.data.loc[
-            cur_month( Date(*self.data['date'].split('.')) ),
-            ['date', 'time', 'purpose', 'amount', 'currency', 'description']
-        ]
-        status = len(frames) > 0
-        return status, frames
+    def get_month_totals(self, date):
+        ''' per (role, purpose, currency) month totals,
+            read from the running aggregates
+        '''
+        date = parse_date(date)
+        return totals_frame(self._month_totals(date.year, date.month))
 
-    def get_duty_entries(self, date):
-        '''Everythng without pocket_money and targets is a duty
-           Show how much everyone spent on duties. 
-           Later on we could substract this from the salary to 
-           compute the member debt.
+    @metrics.timed('stage.filter')
+    def get_history_totals(self, first=None, last=None):
+        ''' (year, month) -> per (role, purpose, currency) totals of
+            every month with records, from the first to the last
+            (year, month) inclusive, read from the running aggregates
         '''
-        frames = self.get_month_entries(date)
-        nodept_categories = ['pocket_money', 'targets']
-        nodebt_filter = lambda rec: rec['purpose'] not in nodept_categories
-        frames = frames.loc [
-            frames.apply(nodebt_filter, axis=1),
-            ['role', 'amount', 'currency', 'purpose', 'description']
-        ]
-        status = len(frames) > 0
-        return status, frames
+        return {
+            key: self._month_totals(*key)
+            for key in self._stored_months(first, last)
+        }
+
+    @metrics.timed('stage.filter')
+    def get_range_totals(self, first, last):
+        ''' per (role, purpose, currency) totals from the first to
+            the last 'dd.mm.yyyy' day inclusive. Only months holding
+            records are visited: whole months come from the running
+            aggregates, the edge months are scanned between their
+            date bounds.
+        '''
+        first, last = parse_date(first), parse_date(last)
+        begin = pd.Timestamp(first.year, first.month, first.day)
+        end = pd.Timestamp(last.year, last.month, last.day) + pd.Timedelta(days=1)
+        totals = {}
+        for year, month in self._stored_months(
+            (first.year, first.month), (last.year, last.month)
+        ):
+            month_begin = pd.Timestamp(year, month, 1)
+            month_end = month_begin + pd.offsets.MonthBegin(1)
+            if begin <= month_begin and month_end <= end:
+                month_totals = self._month_totals(year, month)
+            else:
+                frames = self._month_frame(year, month)
+                start, stop = frames['timestamp'].searchsorted([begin, end])
+                month_totals = self.aggregates.rebuild(
+                    frames.iloc[start:stop]
+                ).get((year, month), {})
+            for key, amount in month_totals.items():
+                totals[key] = totals.get(key, 0.0) + amount
+        return totals
 
+    @metrics.timed('stage.filter')
     def get_pocket_summary(self, date):
-        frames = self.get_month_entries(date)
+        frames = self.get_month_totals(date)
         frames = frames.loc[
             frames['purpose']=='pocket_money',
             ['role', 'amount', 'currency']
@@ -68,8 +466,9 @@ class Database:
         status = len(frames) > 0
         return status, frames
 
+    @metrics.timed('stage.filter')
     def get_groceries_summary(self, date):
-        frames = self.get_month_entries(date)
+        frames = self.get_month_totals(date)
         frames = frames.loc[
             frames['purpose']=='groceries',
             ['amount', 'currency']
@@ -0,0 +1,204 @@
+import os
+import time
+import threading
+from functools import partial
+from collections import OrderedDict
+from contextlib import contextmanager
+from cache import SingleFlight
+from config import configs
+from render import RenderPool
+
+class Household:
+    ''' One family: its grossbook, budget.json and telegram.json
+        with the allowed users, all inside its own directory.
+    '''
+    def __init__(self, name: str, directory: str, currency: str,
+                 render_pool: RenderPool) -> None:
+        # pandas comes with these, the bot is polling before it is needed
+        from authentication import TelegramAuth
+        from busines_logic import Logic
+        self.name = name
+        telegram_config = os.path.join(directory, 'telegram.json')
+        self.auth = TelegramAuth(telegram_config)
+        # grossbook.db is sqlite, grossbook.arrow columnar,
+        # a name without extension a directory of month partitions
+        grossbook = self.auth.config.get('grossbook', 'grossbook.db')
+        self.logic = Logic(
+            os.path.join(directory, grossbook),
+            telegram_config,
+            os.path.join(directory, 'budget.json'),
+            currency,
+            render_pool=render_pool
+        )
+        # handlers currently inside use(), never evicted while > 0
+        self.active = 0
+        self.last_used = time.monotonic()
+
+    def close(self) -> None:
+        self.logic.close()
+        self.auth.close()
+
+class Households:
+    ''' Routes chats to households, one bot process serves them all.
+        Households are loaded on first use; idle ones are closed when
+        more than max_resident are loaded or after max_idle seconds.
+        Without a "households" section in the bot config the working
+        directory is the only household and every chat belongs to it.
+    '''
+    def __init__(self, config_name: str, currency: str,
+                 render_pool: RenderPool) -> None:
+        self.config_name = config_name
+        self.currency = currency
+        self.render_pool = render_pool
+        self.resident = OrderedDict()
+        self.lock = threading.Lock()
+        # a household is read once even if its chats all write at once
+        self.loads = SingleFlight()
+        configs.subscribe(config_name, self.apply)
+
+    def apply(self, config: dict) -> None:
+        if 'households' in config:
+            directories = dict(config['households'])
+            # json keys are strings, chat ids are not
+            routes = {
+                int(chat_id): name
+                for chat_id, name in config.get('routes', {}).items()
+            }
+            default = None
+        else:
+            directories, routes, default = {'': ''}, {}, ''
+        # everything is checked, now switch
+        self.config = config
+        # user ids allowed to see /stats and to profile
+        self.admins = frozenset(config.get('admins', []))
+        self.max_resident = config.get('max_households', 32)
+        self.max_idle = config.get('household_idle', 3600)
+        self.directories, self.routes, self.default = directories, routes, default
+
+    def route(self, chat_id: int) -> str:
+        ''' household name of a chat, None for unknown chats '''
+        name = self.routes.get(chat_id, self.default)
+        return name if name in self.directories else None
+
+    def link(self, chat_id: int, name: str) -> None:
+        ''' route a chat to a household from now on '''
+        if self.default is not None or self.routes.get(chat_id) == name:
+            return
+        with configs.lock:
+            routes = dict(self.config.get('routes', {}), **{str(chat_id): name})
+            config = dict(self.config, routes=routes)
+            configs.store(self.config_name, config)
+            self.apply(config)
+
+    @contextmanager
+    def use(self, name: str):
+        ''' the loaded household, kept resident while in use '''
+        household = self._acquire(name)
+        try:
+            yield household
+        finally:
+            self._release(household)
+
+    def evict(self, max_idle: float = None) -> int:
+        ''' close idle households beyond max_resident and those
+            unused for max_idle seconds, returns how many were closed
+        '''
+        max_idle = self.max_idle if max_idle is None else max_idle
+        now = time.monotonic()
+        evicted = []
+        with self.lock:
+            excess = len(self.resident) - self.max_resident
+            # least recently used first
+            for name, household in list(self.resident.items()):
+                if household.active > 0:
+                    continue
+                if excess > 0 or now - household.last_used > max_idle:
+                    evicted.append(self.resident.pop(name))
+                    excess -= 1
+        for household in evicted:
+            household.close()
+        return len(evicted)
+
+    def payments(self, name: str) -> tuple:
+        ''' chats and due payments report of a household for the
+            daily job. Only a loaded household answers from its
+            Logic, the others read their two configs and nothing else.
+        '''
+        household = self._acquire(name, load=False)
+        if household is not None:
+            try:
+                remind_days = household.auth.config.get('remind_days', 0)
+                return household.auth.chats(), household.logic.dayly_job(remind_days)
+            finally:
+                self._release(household)
+        from authentication import TelegramAuth
+        from busines_logic import payments_report
+        from pay_calc import PayCalc
+        directory = self.directories[name]
+        auth = TelegramAuth(os.path.join(directory, 'telegram.json'))
+        pay_calc = PayCalc(os.path.join(directory, 'budget.json'), self.currency)
+        try:
+            report = payments_report(
+                pay_calc, self.render_pool, auth.config.get('remind_days', 0)
+            )
+            return auth.chats(), report
+        finally:
+            pay_calc.close()
+            auth.close()
+
+    def names(self) -> list:
+        return list(self.directories)
+
+    def warm(self, names: list = None) -> None:
+        ''' load households ahead of their first message, the only
+            household by default, or just the heavy imports
+        '''
+        if names is None:
+            names = [] if self.default is None else [self.default]
+        import busines_logic
+        for name in names:
+            with self.use(name):
+                pass
+
+    def close(self) -> None:
+        ''' close every household, their warm state is saved '''
+        with self.lock:
+            closing = list(self.resident.values())
+            self.resident.clear()
+        for household in closing:
+            household.close()
+
+    def _acquire(self, name: str, load: bool = True) -> Household:
+        ''' the resident household marked active, loaded if need be,
+            None when it is not resident and load is False
+        '''
+        while True:
+            with self.lock:
+                household = self.resident.get(name)
+                if household is not None:
+                    household.active += 1
+                    self.resident.move_to_end(name)
+                    return household
+            if not load:
+                return None
+            # evicted again before we got it, then it is loaded again
+            self.loads.do((name,), partial(self._load, name))
+
+    def _release(self, household: Household) -> None:
+        with self.lock:
+            household.active -= 1
+            household.last_used = time.monotonic()
+        self.evict()
+
+    def _load(self, name: str) -> None:
+        with self.lock:
+            if name in self.resident:
+                return
+        household = Household(
+            name, self.directories[name], self.currency, self.render_pool
+        )
+        with self.lock:
+            if name not in self.resident:
+                self.resident[name] = household
+                return
+        household.close()
@@ -0,0 +1,96 @@
+''' Bulk import of historical expenses.
+
+    python importer.py grossbook.db statement.csv --role ann
+
+    The csv needs date, purpose and amount columns; time, role,
+    currency and description are optional. Every row is checked with
+    the same rules as a '#purpose' message and all accepted rows are
+    written in a single transaction.
+
+    A running bot keeps the grossbook in memory and does not see rows
+    imported this way until it restarts; send the csv to the bot with
+    the /import caption to have them counted right away.
+'''
+import io
+import os
+import csv
+import time
+import argparse
+from database import Database
+from storage import open_storage
+from config import configs
+from message_parser import MessageParser
+
+# rejected lines listed in a reply, the rest are only counted
+MAX_REPORTED = 10
+
+class ImportResult:
+    def __init__(self, accepted: int, rejected: list, seconds: float) -> None:
+        self.accepted = accepted
+        self.rejected = rejected
+        self.seconds = seconds
+
+    def rate(self) -> float:
+        total = self.accepted + len(self.rejected)
+        return total / self.seconds if self.seconds > 0 else 0.0
+
+    def summary(self) -> str:
+        lines = [
+            f'imported {self.accepted} rows, rejected {len(self.rejected)}',
+            f'{self.rate():,.0f} rows/s',
+        ]
+        for line_num, error in self.rejected[:MAX_REPORTED]:
+            lines.append(f'line {line_num}: ' + error.split('\n')[0])
+        if len(self.rejected) > MAX_REPORTED:
+            lines.append(f'... and {len(self.rejected) - MAX_REPORTED} more')
+        return '\n'.join(lines)
+
+def parse_csv(parser: MessageParser, text: str, role: str) -> tuple:
+    ''' accepted records and (line, error) of the rejected rows '''
+    records = []
+    rejected = []
+    reader = csv.DictReader(io.StringIO(text))
+    for row in reader:
+        record, status = parser.parse_row(row, role)
+        if record is None:
+            rejected.append((reader.line_num, status))
+        else:
+            records.append(record)
+    return records, rejected
+
+def import_csv(database: Database, parser: MessageParser, text: str, role: str) -> ImportResult:
+    start = time.perf_counter()
+    records, rejected = parse_csv(parser, text, role)
+    database.add_records(records)
+    return ImportResult(len(records), rejected, time.perf_counter() - start)
+
+def main() -> None:
+    arg_parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    arg_parser.add_argument('database')
+    arg_parser.add_argument('csv')
+    arg_parser.add_argument('--role', required=True, help='role of rows without one')
+    arg_parser.add_argument('--budget', default='budget.json')
+    arg_parser.add_argument('--telegram', default='telegram.json')
+    args = arg_parser.parse_args()
+
+    parser = MessageParser(configs.load(args.budget), configs.load(args.telegram))
+    with open(args.csv, encoding='utf-8-sig') as csv_file:
+        text = csv_file.read()
+    start = time.perf_counter()
+    records, rejected = parse_csv(parser, text, args.role)
+    # appended straight to the storage, the grossbook is never loaded
+    storage = open_storage(args.database)
+    try:
+        # the legacy grossbook.csv is only taken over by an empty
+        # storage, so it has to go in before the first import does
+        storage.migrate_csv(os.path.splitext(args.database)[0] + '.csv')
+        if records:
+            storage.append(records)
+    finally:
+        storage.close()
+    print(ImportResult(len(records), rejected, time.perf_counter() - start).summary())
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,155 @@
+import re
+import time as clock
+from pay_calc import CURRENCY_NAMES
+
+AMOUNT = re.compile(
+    r'([+-]?(?:[0-9]+(?:\.[0-9]*)?|\.[0-9]+))\s*([$€₽]|rub|eur|usd|EUR|USD|RUB)'
+)
+
+# budget independent categories
+BUILTIN_CATEGORIES = ('pocket_money', 'targets')
+
+# an abbreviation must be at least this long to be accepted
+MIN_PREFIX = 3
+
+FORMAT_ERROR = (
+    'wrong message format\n'
+    'should be:\n'
+    '#purpose\n'
+    'description\n'
+    '+-amount'
+)
+CATEGORY_ERROR = (
+    'category unrecognized\n'
+    'see \\help\n'
+)
+DATE_ERROR = (
+    'date unrecognized\n'
+    'should be dd.mm.yyyy or yyyy-mm-dd'
+)
+TIME_ERROR = (
+    'time unrecognized\n'
+    'should be hh:mm'
+)
+ROLE_ERROR = 'role unrecognized'
+AMOUNT_ERROR = (
+    'amount unrecognized\n'
+    'should be a number followed by a currency symbol'
+)
+
+class MessageParser:
+    ''' Turns '#purpose / description / +-amount' messages into
+        grossbook records. Built once per config version, so parsing
+        a message is a few dict lookups and one precompiled match.
+        Several entries may follow each other in one message, each
+        starting with a '#category' line.
+    '''
+    def __init__(self, budget: dict, telegram: dict) -> None:
+        categories = [ex['purpose'].lower() for ex in budget['expenses']]
+        self.categories = frozenset(categories).union(BUILTIN_CATEGORIES)
+        # every unambiguous abbreviation of a category
+        prefixes = {}
+        for category in self.categories:
+            for end in range(MIN_PREFIX, len(category)):
+                prefixes.setdefault(category[:end], set()).add(category)
+        self.lookup = {
+            prefix: matches.pop()
+            for prefix, matches in prefixes.items() if len(matches) == 1
+        }
+        for alias, category in budget.get('aliases', {}).items():
+            if category.lower() in self.categories:
+                self.lookup[alias.lower()] = category.lower()
+        self.lookup.update((category, category) for category in self.categories)
+        self.roles = {
+            user_id: role for role, user_id in telegram['allowed_users'].items()
+        }
+
+    def category(self, word: str) -> str:
+        return self.lookup.get(word.strip().lower())
+
+    def parse(self, text: str, user_id: int, date: str, time: str):
+        ''' returns (records, 'ok') or (None, error) for the
+            first broken entry, nothing is accepted partially
+        '''
+        lines = [line.strip() for line in text.split('\n')]
+        starts = [num for num, line in enumerate(lines) if line.startswith('#')]
+        if not starts or any(line for line in lines[:starts[0]]):
+            return None, FORMAT_ERROR
+        # a later '#word' starts an entry only when it names a category,
+        # otherwise it is part of the description, like '#hashtag note'
+        starts = starts[:1] + [
+            num for num in starts[1:] if self.category(lines[num][1:]) is not None
+        ]
+        records = []
+        for num, (start, stop) in enumerate(zip(starts, starts[1:] + [len(lines)])):
+            record, status = self.parse_entry(
+                lines[start:stop], user_id, date, time
+            )
+            if record is None:
+                if len(starts) > 1:
+                    status = f'entry {num + 1}: {status}'
+                return None, status
+            records.append(record)
+        return records, 'ok'
+
+    def parse_entry(self, lines: list, user_id: int, date: str, time: str):
+        while lines and not lines[-1]:
+            lines = lines[:-1]
+        if len(lines) < 2:
+            return None, FORMAT_ERROR
+        # everything except the leading # symbol
+        category = self.category(lines[0][1:])
+        if category is None:
+            return None, CATEGORY_ERROR
+        amount = AMOUNT.match(lines[-1])
+        if not amount:
+            return None, AMOUNT_ERROR
+        return {
+            'date': date,
+            'time': time,
+            'purpose': category,
+            'role': self.roles[user_id],
+            'amount': float(amount.group(1)),
+            # get currency in well known format
+            'currency': CURRENCY_NAMES[amount.group(2)],
+            'description': '\n'.join(lines[1:-1]).replace(',', '.')
+        }, 'ok'
+
+    def parse_row(self, row: dict, role: str):
+        ''' validate one imported csv row with the message rules,
+            the amount may carry its currency or have its own column
+        '''
+        date = (row.get('date') or '').strip()
+        for date_format in ('%d.%m.%Y', '%Y-%m-%d'):
+            try:
+                date = clock.strftime('%d.%m.%Y', clock.strptime(date, date_format))
+                break
+            except ValueError:
+                pass
+        else:
+            return None, DATE_ERROR
+        row_time = (row.get('time') or '00:00').strip()
+        try:
+            clock.strptime(row_time, '%H:%M')
+        except ValueError:
+            return None, TIME_ERROR
+        row_role = (row.get('role') or role).strip()
+        if row_role not in self.roles.values():
+            return None, ROLE_ERROR
+        category = self.category(row.get('purpose') or '')
+        if category is None:
+            return None, CATEGORY_ERROR
+        amount = AMOUNT.fullmatch(
+            f"{row.get('amount') or ''} {row.get('currency') or ''}".strip()
+        )
+        if not amount:
+            return None, AMOUNT_ERROR
+        return {
+            'date': date,
+            'time': row_time,
+            'purpose': category,
+            'role': row_role,
+            'amount': float(amount.group(1)),
+            'currency': CURRENCY_NAMES[amount.group(2)],
+            'description': (row.get('description') or '').replace(',', '.')
+        }, 'ok'
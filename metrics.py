@@ -0,0 +1,195 @@
+import io
+import sys
+import time
+import pstats
+import cProfile
+import resource
+import threading
+from functools import wraps
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# upper bounds in seconds, the last bucket catches everything slower
+BUCKETS = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+    0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, float('inf')
+)
+
+class Histogram:
+    ''' Fixed-bucket latency histogram, cheap enough to
+        record every handler call and pipeline stage.
+    '''
+    def __init__(self) -> None:
+        self.counts = [0] * len(BUCKETS)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds: float) -> None:
+        for num, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                self.counts[num] += 1
+                break
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def percentile(self, fraction: float) -> float:
+        ''' upper bound of the bucket holding the percentile '''
+        rank = fraction * self.count
+        seen = 0
+        for bound, count in zip(BUCKETS, self.counts):
+            seen += count
+            if seen >= rank and count:
+                return min(bound, self.max)
+        return self.max
+
+def max_rss() -> int:
+    # linux reports kilobytes, macos bytes
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+def cpu_seconds() -> float:
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+class Metrics:
+    ''' Process wide registry of latency histograms by name,
+        plus gauges read on demand when the stats are shown.
+    '''
+    def __init__(self) -> None:
+        self.histograms = {}
+        self.gauges = {
+            'cpu_seconds': cpu_seconds,
+            'max_rss_bytes': max_rss,
+            'threads': threading.active_count,
+        }
+        self.lock = threading.Lock()
+
+    def gauge(self, name: str, read) -> None:
+        ''' read() is called whenever the stats are shown '''
+        self.gauges[name] = read
+
+    def observe(self, name: str, seconds: float) -> None:
+        with self.lock:
+            self.histograms.setdefault(name, Histogram()).observe(seconds)
+
+    @contextmanager
+    def timer(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    def timed(self, name: str):
+        ''' decorator recording every call of a function '''
+        def decorator(func):
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.timer(name):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def summary(self) -> str:
+        ''' plain text table for the /stats command '''
+        lines = [f'{"name":<24}{"n":>6}{"p50":>8}{"p90":>8}{"p99":>8}{"max":>8} ms']
+        with self.lock:
+            for name, hist in sorted(self.histograms.items()):
+                lines.append(
+                    f'{name:<24}{hist.count:>6}'
+                    + ''.join(
+                        f'{hist.percentile(fraction) * 1000:>8.1f}'
+                        for fraction in (0.5, 0.9, 0.99)
+                    )
+                    + f'{hist.max * 1000:>8.1f}'
+                )
+        lines.append('')
+        for name, read in sorted(self.gauges.items()):
+            lines.append(f'{name:<24}{read():>14,.1f}')
+        return '\n'.join(lines)
+
+    def prometheus(self) -> str:
+        ''' text exposition format, one histogram per name '''
+        lines = [
+            '# HELP bot_duration_seconds handler and stage latency',
+            '# TYPE bot_duration_seconds histogram',
+        ]
+        with self.lock:
+            for name, hist in sorted(self.histograms.items()):
+                cumulative = 0
+                for bound, count in zip(BUCKETS, hist.counts):
+                    cumulative += count
+                    le = '+Inf' if bound == float('inf') else repr(bound)
+                    lines.append(
+                        f'bot_duration_seconds_bucket{{name="{name}",le="{le}"}} {cumulative}'
+                    )
+                lines.append(f'bot_duration_seconds_sum{{name="{name}"}} {hist.total}')
+                lines.append(f'bot_duration_seconds_count{{name="{name}"}} {hist.count}')
+        for name, read in sorted(self.gauges.items()):
+            lines.append(f'# TYPE bot_{name} gauge')
+            lines.append(f'bot_{name} {read()}')
+        return '\n'.join(lines) + '\n'
+
+    def serve(self, port: int, host: str = '127.0.0.1') -> ThreadingHTTPServer:
+        ''' expose /metrics over http from a daemon thread '''
+        metrics = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self) -> None:
+                if self.path != '/metrics':
+                    self.send_error(404)
+                    return
+                body = metrics.prometheus().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args) -> None:
+                pass
+
+        server = ThreadingHTTPServer((host, port), MetricsHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+class Profiler:
+    ''' cProfile capture of a single slow request. Once armed,
+        requests are profiled one at a time until one takes longer
+        than the threshold, its profile goes to the chat that armed it.
+    '''
+    def __init__(self) -> None:
+        # (chat_id, threshold seconds) while waiting for a slow request
+        self.armed = None
+        self.lock = threading.Lock()
+
+    def arm(self, chat_id: int, threshold: float = 0.0) -> None:
+        with self.lock:
+            self.armed = (chat_id, threshold)
+
+    def take(self) -> tuple:
+        with self.lock:
+            armed, self.armed = self.armed, None
+            return armed
+
+    def run(self, armed: tuple, func, *args, **kwargs):
+        ''' returns the call result and the profile text,
+            None when the call was too fast to be reported
+        '''
+        profile = cProfile.Profile()
+        start = time.perf_counter()
+        result = profile.runcall(func, *args, **kwargs)
+        if time.perf_counter() - start < armed[1]:
+            with self.lock:
+                # wait for the next request unless armed again meanwhile
+                if self.armed is None:
+                    self.armed = armed
+            return result, None
+        output = io.StringIO()
+        pstats.Stats(profile, stream=output).sort_stats('cumulative').print_stats(15)
+        return result, output.getvalue()
+
+metrics = Metrics()
+profiler = Profiler()
@@ -1,29 +1,282 @@
-import json
-from functools import partial
-from functools import reduce
+import calendar
+import datetime
+import numpy as np
+import pandas as pd
+from config import configs
+from metrics import metrics
+
+CURRENCY_NAMES = {
+    '$': 'usd',
+    '₽': 'rub',
+    '€': 'eur',
+    'EUR': 'eur',
+    'RUB': 'rub',
+    'USD': 'usd',
+    'rub': 'rub',
+    'usd': 'usd',
+    'eur': 'eur'
+}
+
+def normalize_currency(currencies: pd.Series) -> pd.Series:
+    # map currency symbols to well known names once per distinct value
+    return currencies.astype('category').map(CURRENCY_NAMES)
+
+# budget.json sections holding amount records, the others
+# (course, aliases) are looked up as they are
+RECORD_SECTIONS = ('expenses', 'incomes', 'pocket_money')
+
+# purposes that are not duties, they never count against the debt
+NODEBT_PURPOSES = ('pocket_money', 'targets')
+
+def month_number(year: int, month: int) -> int:
+    return year * 12 + month - 1
+
+class BudgetPlan:
+    ''' Everything derived from one version of budget.json:
+        amounts converted to the base currency, per-section per-role
+        totals and due-payment calendars per month.
+    '''
+    def __init__(self, budget: dict, currency_name: str) -> None:
+        self.course = budget['course']
+        self.currency_name = currency_name
+        # payments are shown as written in the budget
+        self.raw_expenses = budget['expenses']
+        self.config = {
+            section: [
+                self.convert(rec, currency_name) for rec in budget.get(section, [])
+            ]
+            for section in RECORD_SECTIONS
+        }
+        self.roles = list({
+            rec['role'] for records in self.config.values()
+            for rec in records if rec['role']
+        })
+        self.totals = {}
+        for section, records in self.config.items():
+            totals = dict.fromkeys(self.roles, 0)
+            for rec in records:
+                if rec['role'] in totals:
+                    totals[rec['role']] += rec['amount']
+            self.totals[section] = totals
+        self.debt = {
+            role: self.totals['incomes'][role]
+                - self.totals['expenses'][role]
+                - self.totals['pocket_money'][role]
+            for role in self.roles
+        }
+        # (year, month, remind_days) -> calendar, built on first use
+        self.calendars = {}
+
+    def due_calendar(self, year: int, month: int, remind_days: int = 0) -> dict:
+        ''' day of month -> payments due that day or within the next
+            remind_days. A payment day past the end of a short month
+            is due on its last day.
+        '''
+        key = (year, month, remind_days)
+        days = self.calendars.get(key)
+        if days is not None:
+            return days
+        first = datetime.date(year, month, 1)
+        last = first.replace(day=calendar.monthrange(year, month)[1])
+        horizon = last + datetime.timedelta(days=remind_days)
+        due_payments = []
+        # reminders may point into the following months
+        due_month = first
+        while due_month <= horizon:
+            month_days = calendar.monthrange(due_month.year, due_month.month)[1]
+            for expense in self.raw_expenses:
+                if expense.get('date'):
+                    due = due_month.replace(day=min(expense['date'], month_days))
+                    due_payments.append((due, expense))
+            due_month = (due_month + datetime.timedelta(days=31)).replace(day=1)
+        days = {}
+        for due, expense in sorted(due_payments, key=lambda payment: payment[0]):
+            for ahead in range(remind_days + 1):
+                day = due - datetime.timedelta(days=ahead)
+                if first <= day <= last:
+                    days.setdefault(day.day, []).append(
+                        dict(expense, date=due.strftime('%d.%m.%Y'))
+                    )
+        self.calendars[key] = days
+        return days
+
+    def convert(self, record: dict, currency: str) -> dict:
+        rate = self.course[record['currency']][currency]
+        return dict(record, amount=record['amount'] * rate, currency=currency)
+
+class Projection:
+    ''' The budget plan against the grossbook history as arrays over
+        role × purpose × month, in the base currency. Spendings are
+        negative, as in the grossbook. Months after the current one
+        are a forecast: duties cost what the plan says and nothing
+        is paid towards the targets.
+
+        planned  role × purpose, the monthly plan of expenses
+        actual   role × purpose × month, booked amounts
+        booked   role × purpose × month, whether anything was booked
+        spent    role × month, duties booked or, later, planned
+        debt     role × month, incomes - pocket money + spent
+        running  role × month, debt accumulated since the first month
+                 less what was paid towards the targets
+    '''
+    def __init__(self, plan: BudgetPlan, history: dict,
+                 first: tuple, current: tuple, forecast: int = 0) -> None:
+        start = month_number(*first)
+        self.current = month_number(*current) - start
+        self.months = [
+            (number // 12, number % 12 + 1)
+            for number in range(start, start + self.current + forecast + 1)
+        ]
+        # the plan fixes the order of the axes, the history may extend them
+        role_index = {role: num for num, role in enumerate(plan.roles)}
+        purpose_index = {}
+        for purpose in [rec['purpose'] for rec in plan.config['expenses']]:
+            purpose_index.setdefault(purpose, len(purpose_index))
+        # only plan purposes are shown as left to pay
+        planned_purposes = len(purpose_index)
+        for purpose in NODEBT_PURPOSES:
+            purpose_index.setdefault(purpose, len(purpose_index))
+        rates = {
+            currency: rates[plan.currency_name]
+            for currency, rates in plan.course.items()
+        }
+        # a code per distinct (role, purpose, currency), the totals of
+        # every month are then placed and converted by numpy
+        keys, codes, months, amounts = {}, [], [], []
+        for (year, month), totals in history.items():
+            number = month_number(year, month) - start
+            if not 0 <= number <= self.current:
+                continue
+            for key in totals.keys() - keys.keys():
+                keys[key] = len(keys)
+            codes.extend(map(keys.__getitem__, totals))
+            amounts.extend(totals.values())
+            months.extend([number] * len(totals))
+        key_roles = np.array([
+            role_index.setdefault(role, len(role_index)) for role, _, _ in keys
+        ], dtype=int)
+        key_purposes = np.array([
+            purpose_index.setdefault(purpose, len(purpose_index))
+            for _, purpose, _ in keys
+        ], dtype=int)
+        key_rates = np.array([rates[currency] for _, _, currency in keys], dtype=float)
+        codes = np.array(codes, dtype=int)
+        expenses = plan.config['expenses']
+        plan_roles = [
+            role_index.setdefault(rec['role'], len(role_index)) for rec in expenses
+        ]
+        plan_purposes = [purpose_index[rec['purpose']] for rec in expenses]
+        self.roles = list(role_index)
+        self.purposes = list(purpose_index)
+
+        shape = (len(self.roles), len(self.purposes), len(self.months))
+        self.planned = np.zeros(shape[:2])
+        np.add.at(
+            self.planned,
+            (np.array(plan_roles, dtype=int), np.array(plan_purposes, dtype=int)),
+            [rec['amount'] for rec in expenses]
+        )
+        booked = (key_roles[codes], key_purposes[codes], np.array(months, dtype=int))
+        self.actual = np.zeros(shape)
+        np.add.at(self.actual, booked, np.array(amounts) * key_rates[codes])
+        self.booked = np.zeros(shape, dtype=bool)
+        self.booked[booked] = True
+        self.plan_mask = np.arange(len(self.purposes)) < planned_purposes
+        self.duties = ~np.isin(self.purposes, NODEBT_PURPOSES)
+
+        past = slice(0, self.current + 1)
+        future = slice(self.current + 1, None)
+        self.spent = np.empty((len(self.roles), len(self.months)))
+        self.spent[:, past] = self.actual[:, self.duties, past].sum(axis=1)
+        self.spent[:, future] = -self.planned[:, self.duties].sum(axis=1)[:, None]
+        incomes, pocket_money = (
+            np.array([plan.totals[section].get(role, 0.0) for role in self.roles])
+            for section in ('incomes', 'pocket_money')
+        )
+        self.debt = (incomes - pocket_money)[:, None] + self.spent
+        # targets are booked negative, paying them off lowers the debt
+        paid = -self.actual[:, self.purposes.index('targets'), :]
+        self.running = np.cumsum(self.debt - paid, axis=1)
+
+    def duties_booked(self, month: int) -> np.ndarray:
+        ''' per role, whether any duty was booked in a month '''
+        return self.booked[:, self.duties, month].any(axis=1)
+
+    def left(self, month: int) -> tuple:
+        ''' plan purposes and how much of their plan is left in a month '''
+        left = self.planned.sum(axis=0) + self.actual[:, :, month].sum(axis=0)
+        purposes = [
+            purpose for purpose, planned in zip(self.purposes, self.plan_mask)
+            if planned
+        ]
+        return purposes, left[self.plan_mask]
 
 class PayCalc:
     def __init__(self, config_name: str, currency_name: str):
         self.config_name = config_name
-        self.config = self.get_config(config_name, currency_name)
-        self.roles = self.get_roles()
-        self.expenses = self.get_expenses()
-        self.incomes = self.get_incomes()
-        self.pocket_money = self.get_pocket_money()
-        self.debt = self.get_role_debt()
+        self.currency_name = currency_name
+        # bumped whenever the budget is reloaded
+        self.version = 0
+        configs.subscribe(config_name, self.apply)
+
+    def apply(self, budget: dict) -> None:
+        # build the new plan aside, readers switch in one assignment
+        self.budget = BudgetPlan(budget, self.currency_name)
+        self.version += 1
+
+    def close(self) -> None:
+        configs.unsubscribe(self.config_name, self.apply)
+
+    def reload(self) -> bool:
+        # explicit reload, only when the budget file changed
+        return self.config_name in configs.poll([self.config_name])
+
+    @property
+    def course(self) -> dict:
+        return self.budget.course
+
+    @property
+    def config(self) -> dict:
+        return self.budget.config
+
+    @property
+    def roles(self) -> list:
+        return self.budget.roles
+
+    @property
+    def expenses(self) -> dict:
+        return self.get_expenses()
+
+    @property
+    def incomes(self) -> dict:
+        return self.get_incomes()
+
+    @property
+    def pocket_money(self) -> dict:
+        return self.get_pocket_money()
+
+    @property
+    def debt(self) -> dict:
+        return self.get_role_debt()
 
     def convert_currency_name(self, currency_name: str) -> str:
-        return {
-            '$': 'usd',
-            '₽': 'rub',
-            '€': 'eur',
-            'EUR': 'eur',
-            'RUB': 'rub',
-            'USD': 'usd',
-            'rub': 'rub',
-            'usd': 'usd',
-            'eur': 'eur'
-        }[currency_name]
+        return CURRENCY_NAMES[currency_name]
+
+    def normalize_currency(self, currencies: pd.Series) -> pd.Series:
+        return normalize_currency(currencies)
+
+    @metrics.timed('stage.convert')
+    def convert_frame(self, frames: pd.DataFrame, currency: str) -> pd.DataFrame:
+        # convert the whole amount column to a given currency at once
+        codes = frames['currency'].astype('category')
+        rates = np.array(
+            [self.course[name][currency] for name in codes.cat.categories],
+            dtype=float
+        )
+        return frames.assign(
+            amount=frames['amount'].to_numpy() * rates[codes.cat.codes.to_numpy()],
+            currency=currency
+        )
 
     def convert_amount(self, amount, currency_in, currency_out):
         # convert amount from one currency to a given one
@@ -40,47 +293,37 @@ class PayCalc:
         role_records = list(filter(lambda rec: rec['role'] == role, section))
         return sum(map(lambda rec: rec['amount'], role_records))
 
-    def get_config(self, config_name:str, currency_name: str) -> dict:
-        with open(config_name, 'r') as config_file:
-            config = json.load(config_file)
-        self.course = config['course']
-        converter = partial(self.convert_currency, currency_name)
-        config = {k: list(map(converter, v)) for k, v in config.items() if k != 'course'}
-        return config
-
     def get_roles(self) -> list:
         # get roles list
-        records = list(reduce(lambda x, y: x + y, self.config.values()))
-        roles =  list(set(map(lambda rec: rec['role'], records)))
-        return list(filter(lambda role: role, roles))
+        return self.roles
 
     def get_expenses(self) -> dict:
         #get role expenses dict
-        roles = self.get_roles()
-        expenses = dict(map(lambda role: (role, self.section_sum(self.config['expenses'], role)), roles))
-        return expenses
+        return self.budget.totals['expenses']
 
     def get_incomes(self) -> dict:
         #get role expenses dict
-        roles = self.get_roles()
-        incomes = dict(map(lambda role: (role, self.section_sum(self.config['incomes'], role)), roles))
-        return incomes
+        return self.budget.totals['incomes']
 
     def get_pocket_money(self) -> dict:
         # get role pocket money dict
-        roles = self.get_roles()
-        pocket_money = dict(map(lambda role: (role, self.section_sum(self.config['pocket_money'], role)), roles))
-        return pocket_money
+        return self.budget.totals['pocket_money']
 
-    def get_today_payments(self, day: int) -> dict:
-        with open(self.config_name, 'r') as config_file:
-            config = json.load(config_file)
-        return list(filter(lambda ex:ex['date'] == day, config['expenses']))
+    def get_due_payments(self, date: datetime.date, remind_days: int = 0) -> list:
+        # payments due on date and, as reminders, in the next remind_days
+        return self.budget.due_calendar(
+            date.year, date.month, remind_days
+        ).get(date.day, [])
 
     def get_role_debt(self) -> dict:
         # get role debt dict
-        incomes = self.get_incomes()
-        expenses = self.get_expenses()
-        pocket_money = self.get_pocket_money()
-        role_debt = lambda role: incomes[role] - expenses[role] - pocket_money[role]
-        return dict(map(lambda role: (role, role_debt(role)), self.get_roles()))
\ No newline at end of file
+        return self.budget.debt
+
+    @metrics.timed('stage.aggregate')
+    def project(self, history: dict, first: tuple, current: tuple,
+                forecast: int = 0) -> Projection:
+        ''' project the current budget over the (year, month) ->
+            totals history from the first month, forecast months
+            past the current one
+        '''
+        return Projection(self.budget, history, first, current, forecast)
@@ -0,0 +1,182 @@
+import io
+import logging
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import lru_cache
+from PIL import Image, ImageDraw, ImageFont
+
+@lru_cache(maxsize=None)
+def load_font(font_name: str, size: int) -> ImageFont.ImageFont:
+    # fonts are parsed once per process
+    try:
+        return ImageFont.truetype(font_name, size)
+    except OSError:
+        return ImageFont.load_default(size)
+
+class DfiRenderer:
+    ''' dataframe_image export, drives a headless browser per call '''
+    def prepare(self, frames: 'pandas.DataFrame') -> 'pandas.DataFrame':
+        return frames
+
+    def draw(self, frames: 'pandas.DataFrame') -> bytes:
+        # imported on the first report, it pulls in a browser driver
+        import dataframe_image
+        image = io.BytesIO()
+        dataframe_image.export(frames, image)
+        return image.getvalue()
+
+    def render(self, frames: 'pandas.DataFrame') -> bytes:
+        return self.draw(self.prepare(frames))
+
+class TableRenderer:
+    ''' Draws a frame as a plain table with Pillow. '''
+    def __init__(self,
+        font_name: str = 'DejaVuSans.ttf',
+        bold_font_name: str = 'DejaVuSans-Bold.ttf',
+        font_size: int = 14
+    ) -> None:
+        self.font = load_font(font_name, font_size)
+        self.bold_font = load_font(bold_font_name, font_size)
+        self.padding = font_size // 2
+        self.row_height = font_size + 2 * self.padding
+        # bold glyphs are wider, measuring with them fits every cell
+        self.text_width = lru_cache(maxsize=4096)(self.bold_font.getlength)
+        self.text_mask = lru_cache(maxsize=4096)(self._text_mask)
+
+    def _text_mask(self, text: str, bold: bool) -> Image.Image:
+        # glyph rendering dominates, repeated cells reuse the mask
+        font = self.bold_font if bold else self.font
+        left, top, right, bottom = font.getbbox(text)
+        mask = Image.new('L', (max(right, 1), max(bottom, 1)), 0)
+        ImageDraw.Draw(mask).text((0, 0), text, fill=255, font=font)
+        return mask
+
+    def prepare(self, frames: 'pandas.DataFrame') -> list:
+        # plain strings, drawing them needs neither pandas nor the frame
+        return self.cells(frames)
+
+    def cells(self, frames: 'pandas.DataFrame') -> list:
+        ''' index and values as strings, header first '''
+        header = [frames.index.name or ''] + list(map(str, frames.columns))
+        rows = [header]
+        for index, values in zip(frames.index, frames.itertuples(index=False)):
+            rows.append([self.format_value(index)] + list(map(self.format_value, values)))
+        return rows
+
+    def format_value(self, value) -> str:
+        if isinstance(value, float):
+            return f'{value:.2f}'
+        # cells are single line, multi-line descriptions are joined
+        return str(value).replace('\n', ' ')
+
+    def render(self, frames: 'pandas.DataFrame') -> bytes:
+        return self.draw(self.cells(frames))
+
+    def draw(self, rows: list) -> bytes:
+        widths = [
+            int(max(self.text_width(row[col]) for row in rows)) + 2 * self.padding
+            for col in range(len(rows[0]))
+        ]
+        # grayscale keeps both drawing and png encoding cheap
+        image = Image.new(
+            'L', (sum(widths) + 1, len(rows) * self.row_height + 1), 255
+        )
+        draw = ImageDraw.Draw(image)
+        draw.rectangle((0, 0, image.width, self.row_height), fill=232)
+        for line, row in enumerate(rows):
+            top = line * self.row_height
+            if line > 0 and line % 2 == 0:
+                draw.rectangle(
+                    (0, top, image.width, top + self.row_height), fill=245
+                )
+            left = 0
+            for col, (text, width) in enumerate(zip(row, widths)):
+                mask = self.text_mask(text, line == 0 or col == 0)
+                image.paste(
+                    0, (left + self.padding, top + self.padding), mask
+                )
+                left += width
+        draw.line((0, self.row_height, image.width, self.row_height), fill=153)
+        image_bytes = io.BytesIO()
+        image.save(image_bytes, format='PNG', compress_level=1)
+        return image_bytes.getvalue()
+
+logger = logging.getLogger(__name__)
+
+RENDERERS = {
+    'table': TableRenderer,
+    'dfi': DfiRenderer,
+}
+
+# one renderer per pool process, its font and glyph caches stay warm
+worker_renderer = None
+
+def init_worker(renderer_name: str) -> None:
+    global worker_renderer
+    worker_renderer = RENDERERS[renderer_name]()
+
+def draw_in_worker(prepared) -> bytes:
+    return worker_renderer.draw(prepared)
+
+class RenderPool:
+    ''' Renders in a pool of processes, so drawing does not hold
+        the GIL of the handler threads. The calling thread prepares
+        the frame, the table renderer hands over plain cell strings,
+        so workers never import pandas. At most workers + backlog
+        renders are in flight, further callers wait for a free slot.
+        With no workers it renders in the calling thread. A pool whose
+        worker died is replaced.
+    '''
+    def __init__(self, renderer_name: str = 'table',
+                 workers: int = 2, backlog: int = 8) -> None:
+        self.renderer_name = renderer_name
+        self.renderer = RENDERERS[renderer_name]()
+        self.workers = workers
+        self.executor = None
+        self.lock = threading.Lock()
+        if workers > 0:
+            # forked children do not rerun the main module, the pool is
+            # started here before the bot starts its threads
+            self.executor = self._start()
+        self.slots = threading.BoundedSemaphore(workers + backlog)
+
+    def _start(self) -> ProcessPoolExecutor:
+        executor = ProcessPoolExecutor(
+            self.workers, multiprocessing.get_context('fork'),
+            initializer=init_worker, initargs=(self.renderer_name,)
+        )
+        # the first submit forks every worker, they warm up in the background
+        executor.submit(int)
+        return executor
+
+    def render(self, frames: 'pandas.DataFrame') -> bytes:
+        if self.executor is None:
+            return self.renderer.render(frames)
+        prepared = self.renderer.prepare(frames)
+        with self.slots:
+            executor = self.executor
+            try:
+                return executor.submit(draw_in_worker, prepared).result()
+            except BrokenProcessPool:
+                self._restart(executor)
+            # this one is drawn here, the next ones in the new pool
+            return self.renderer.draw(prepared)
+
+    def _restart(self, broken: ProcessPoolExecutor) -> None:
+        with self.lock:
+            # renders failing together restart the pool once
+            if self.executor is not broken:
+                return
+            logger.error('a render worker died, starting a new pool')
+            # now forked from a threaded process, the workers only run
+            # the renderer, which takes none of the locks threads hold
+            self.executor = self._start()
+        broken.shutdown(wait=False)
+
+    def close(self) -> None:
+        with self.lock:
+            executor = self.executor
+        if executor is not None:
+            executor.shutdown()
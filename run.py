@@ -1,9 +1,15 @@
-import json
-import logging
 import time
+import signal
+import logging
+import threading
 import pytz
 import datetime
+from functools import wraps
+from concurrent.futures import ThreadPoolExecutor
 from telegram import Update
+from telegram.error import (
+    TelegramError, RetryAfter, NetworkError, BadRequest, Unauthorized
+)
 
 from telegram.ext import (
     Updater, 
@@ -12,19 +18,29 @@ from telegram.ext import (
     Filters, 
     CallbackContext
 )
-from authentication import TelegramAuth
-from busines_logic import Logic
+from config import configs
+from households import Households
+from render import RenderPool
+from metrics import metrics, profiler
+from webhook import WebhookServer
+
+bot_config = configs.load('telegram.json')
+# households share one pool of rendering processes, 0 draws in the handler thread
+render_pool = RenderPool(
+    bot_config.get('renderer', 'table'),
+    bot_config.get('render_workers', 2)
+)
+households = Households('telegram.json', 'rub', render_pool)
 
-auth = TelegramAuth('telegram.json')
-logic = Logic(
-    'grossbook.csv',
-    'telegram.json',
-    'budget.json',
-    'rub')
+metrics.gauge('households_resident', lambda: len(households.resident))
+metrics.gauge('report_cache_bytes', lambda: sum(
+    household.logic.cache.total_bytes
+    for household in list(households.resident.values())
+))
 
 notify_time = datetime.time(
     hour=10, minute=0, second=0,
-    tzinfo=pytz.timezone(auth.config['timezone'])
+    tzinfo=pytz.timezone(bot_config['timezone'])
 )
 
 # Enable logging
@@ -33,119 +49,275 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-def buy_message(update: Update, context: CallbackContext) -> None:
-    if auth.ok(update):
-        buy_reply =  logic.buy(update)
+# replies and commands are cleaned up after this many seconds
+reply_lifetime = bot_config.get('reply_lifetime', 10)
+
+# daily reports go out to this many chats at a time
+fanout = ThreadPoolExecutor(bot_config.get('fanout_workers', 8))
+
+def delete_job(context: CallbackContext) -> None:
+    for message in context.job.context:
+        try:
+            message.delete()
+        except TelegramError as error:
+            logger.warning('could not delete message: %s', error)
+
+def schedule_delete(context: CallbackContext, *messages) -> None:
+    '''delete messages later from the job queue,
+    so the handler returns right away
+    '''
+    context.job_queue.run_once(delete_job, reply_lifetime, context=messages)
+
+def instrumented(name: str, handler):
+    '''time every call of a handler, profile it when armed by /profile'''
+    @wraps(handler)
+    def wrapper(update: Update, context: CallbackContext) -> None:
+        with metrics.timer('command.' + name):
+            armed = profiler.take()
+            if armed is None:
+                return handler(update, context)
+            result, profile = profiler.run(armed, handler, update, context)
+            if profile is not None:
+                context.bot.send_message(
+                    chat_id=armed[0],
+                    text=f'profile of {name}:\n{profile[:3900]}'
+                )
+            return result
+    return wrapper
+
+def tenant(handler):
+    '''run a handler with the household of the chat,
+    chats of no household are ignored
+    '''
+    @wraps(handler)
+    def wrapper(update: Update, context: CallbackContext) -> None:
+        name = households.route(update.effective_chat.id)
+        if name is None:
+            return
+        with households.use(name) as household:
+            return handler(update, context, household)
+    return wrapper
+
+@metrics.timed('stage.send')
+def send_report(context: CallbackContext, chat_id: int, report):
+    '''send a report photo, reusing the uploaded file when possible'''
+    message = context.bot.send_photo(chat_id=chat_id, photo=report.photo())
+    report.file_id = message.photo[-1].file_id
+    return message
+
+def buy_message(update: Update, context: CallbackContext, household) -> None:
+    if household.auth.ok(update):
+        buy_reply =  household.logic.buy(update)
         noreply = update.message.reply_text(
             buy_reply
         )
-        time.sleep(10)
-        noreply.delete()
+        schedule_delete(context, noreply)
+
+def send_retrying(context: CallbackContext, chat_id: int, report, attempts: int = 5):
+    '''send_report that waits out flood control and network errors'''
+    for attempt in range(attempts):
+        try:
+            return send_report(context, chat_id, report)
+        except RetryAfter as error:
+            delay = error.retry_after
+        except (BadRequest, Unauthorized) as error:
+            # removed or blocked chats will not get better
+            logger.warning('could not send to %s: %s', chat_id, error)
+            return None
+        except NetworkError:
+            delay = 2 ** attempt
+        if attempt + 1 < attempts:
+            time.sleep(delay)
+    logger.warning('gave up sending to %s', chat_id)
+
+def broadcast(context: CallbackContext, chats: list, report) -> None:
+    '''upload the photo once, then send its file_id to the other chats'''
+    for num, chat_id in enumerate(chats):
+        if send_retrying(context, chat_id, report) is not None:
+            break
+    list(fanout.map(
+        lambda chat_id: send_retrying(context, chat_id, report),
+        chats[num + 1:]
+    ))
 
 def dayly_job(context: CallbackContext) -> None:
     print('in the dayly job...')
-    dayly_job_ok = logic.dayly_job()
-    if dayly_job_ok:
-        for chat in context.job.context:
-            context.bot.send_photo(
-                chat_id=chat,
-                photo = open('payments.png', 'rb')
-            )
+    for name in households.names():
+        # payments due today, with reminders of the coming ones,
+        # households that are not loaded stay that way
+        chats, payments = households.payments(name)
+        if payments and chats:
+            broadcast(context, chats, payments)
 
-def expenses_command(update: Update, context: CallbackContext) -> None:
-    if auth.ok(update):
-        expenses_reply = logic.get_expenses(update)
+def schedule_daily(job_queue) -> None:
+    '''one daily job for all households, however often it is asked for'''
+    if not job_queue.get_jobs_by_name('dayly_job'):
+        job_queue.run_daily(dayly_job, time=notify_time, name='dayly_job')
+
+def expenses_command(update: Update, context: CallbackContext, household) -> None:
+    if household.auth.ok(update):
+        expenses_reply = household.logic.get_expenses(update)
         noreply = update.message.reply_text(
             expenses_reply
         )
-        time.sleep(10)
-        noreply.delete()
-        update.message.delete()
+        schedule_delete(context, noreply, update.message)
 
-def left_command(update: Update, context: CallbackContext) -> None:
+def left_command(update: Update, context: CallbackContext, household) -> None:
     '''Show what is left to pay this month form a png image'''
-    if auth.ok(update):
-        left_ok = logic.get_expenses_stats(update)
-        if left_ok:
-            noreply = context.bot.send_photo(
-                chat_id = update.message.chat_id,
-                photo = open('expenses_stats.png', 'rb')
-            )
-        time.sleep(10)
-        noreply.delete()
-        update.message.delete()
+    if household.auth.ok(update):
+        expenses_stats = household.logic.get_expenses_stats(update)
+        if expenses_stats:
+            noreply = send_report(context, update.message.chat_id, expenses_stats)
+            schedule_delete(context, noreply)
+        schedule_delete(context, update.message)
 
 
-def month_command(update: Update, context: CallbackContext) -> None:
-    if auth.ok(update):
-        month_stats_reply = logic.get_month_stats(update)
-        noreply = update.message.reply_text(
-            month_stats_reply
-        )
-        time.sleep(10)
-        noreply.delete()
-        update.message.delete()
+def month_command(update: Update, context: CallbackContext, household) -> None:
+    if household.auth.ok(update):
+        # optional 'mm.yyyy' argument, the current month by default
+        period = context.args[0] if context.args else None
+        month_stats = household.logic.get_month_stats(update, period)
+        if month_stats is None:
+            noreply = update.message.reply_text('usage: /month [mm.yyyy]')
+        elif month_stats:
+            noreply = send_report(context, update.message.chat_id, month_stats)
+        else:
+            noreply = update.message.reply_text('no entries')
+        schedule_delete(context, noreply, update.message)
 
-def day_command(update: Update, context: CallbackContext) -> None:
-    if auth.ok(update):
-        day_stats_ok = logic.get_day_stats(update)
-        if day_stats_ok:
-            context.bot.send_photo(
-                chat_id=update.message.chat_id,
-                photo = open('daystats.png', 'rb')
+def range_command(update: Update, context: CallbackContext, household) -> None:
+    if household.auth.ok(update):
+        if len(context.args) == 2:
+            range_stats = household.logic.get_range_stats(update, *context.args)
+        else:
+            range_stats = None
+        if range_stats is None:
+            noreply = update.message.reply_text(
+                'usage: /range dd.mm.yyyy dd.mm.yyyy'
             )
-        update.message.delete()
+        elif range_stats:
+            noreply = send_report(context, update.message.chat_id, range_stats)
+        else:
+            noreply = update.message.reply_text('no entries')
+        schedule_delete(context, noreply, update.message)
 
-def pocket_command(update: Update, context: CallbackContext) -> None:
-    if auth.ok(update):
-        pocket_stats_ok = logic.get_pocket_summary(update, 'eur')
-        if pocket_stats_ok:
-            noreply = context.bot.send_photo(
-                chat_id=update.message.chat_id,
-                photo = open('pocket_summary.png', 'rb')
-            )
-        time.sleep(10)
-        noreply.delete()
+def day_command(update: Update, context: CallbackContext, household) -> None:
+    if household.auth.ok(update):
+        day_stats = household.logic.get_day_stats(update)
+        if day_stats:
+            send_report(context, update.message.chat_id, day_stats)
         update.message.delete()
 
-def target_command(update: Update, context: CallbackContext) -> None:
+def pocket_command(update: Update, context: CallbackContext, household) -> None:
+    if household.auth.ok(update):
+        pocket_summary = household.logic.get_pocket_summary(update, 'eur')
+        if pocket_summary:
+            noreply = send_report(context, update.message.chat_id, pocket_summary)
+            schedule_delete(context, noreply)
+        schedule_delete(context, update.message)
+
+def target_command(update: Update, context: CallbackContext, household) -> None:
     f''' Will show how big the debt is: 
         All the salary except pocket money and all the amount
         spent on duties (groceries, rent, communal etc.),
         should be paid off. 
     '''
-    if auth.ok(update):
-        targets_ok = logic.get_debt_summary(update)
-        if targets_ok:
-            noreply = context.bot.send_photo(
-                chat_id=update.message.chat_id,
-                photo = open('debt_summary.png', 'rb')
-            )
-        time.sleep(10)
-        noreply.delete()
-        update.message.delete()
+    if household.auth.ok(update):
+        debt_summary = household.logic.get_debt_summary(update)
+        if debt_summary:
+            noreply = send_report(context, update.message.chat_id, debt_summary)
+            schedule_delete(context, noreply)
+        schedule_delete(context, update.message)
 
-def groceries_command(update: Update, context: CallbackContext) -> None:
-    if auth.ok(update):
-        _, groceries_sum = logic.get_groceries_summary(update, 'eur')
+def forecast_command(update: Update, context: CallbackContext, household) -> None:
+    '''running debt of every role, forecast over the optional number of months'''
+    if household.auth.ok(update):
+        try:
+            months = int(context.args[0]) if context.args else 6
+        except ValueError:
+            months = -1
+        if 0 <= months <= 120:
+            forecast = household.logic.get_forecast(update, months)
+        else:
+            forecast = None
+        if forecast:
+            noreply = send_report(context, update.message.chat_id, forecast)
+        else:
+            noreply = update.message.reply_text('usage: /forecast [months up to 120]')
+        schedule_delete(context, noreply, update.message)
+
+def groceries_command(update: Update, context: CallbackContext, household) -> None:
+    if household.auth.ok(update):
+        _, groceries_sum = household.logic.get_groceries_summary(update, 'eur')
         noreply = update.message.reply_text(
             f'Spent on groceries: {groceries_sum} eur'
         )
-        time.sleep(10)
-        noreply.delete()
-        update.message.delete()
+        schedule_delete(context, noreply, update.message)
+
+def rebuild_command(update: Update, context: CallbackContext, household) -> None:
+    '''rescans the whole grossbook, admins only'''
+    if household.auth.ok(update) and update.effective_user.id in households.admins:
+        rebuild_reply = household.logic.rebuild_aggregates(update)
+        noreply = update.message.reply_text(
+            rebuild_reply
+        )
+        schedule_delete(context, noreply, update.message)
+
+def import_document(update: Update, context: CallbackContext, household) -> None:
+    '''csv document sent with an /import caption'''
+    if household.auth.ok(update):
+        data = update.message.document.get_file().download_as_bytearray()
+        try:
+            import_reply = household.logic.import_csv(update, data.decode('utf-8-sig'))
+        except UnicodeDecodeError:
+            import_reply = 'import error 🚫:\nfile is not utf-8 text'
+        update.message.reply_text(import_reply)
+
+def import_command(update: Update, context: CallbackContext, household) -> None:
+    if household.auth.ok(update):
+        noreply = update.message.reply_text(
+            'send a csv file with the /import caption\n'
+            'columns: date, purpose, amount\n'
+            'optional: time, role, currency, description'
+        )
+        schedule_delete(context, noreply, update.message)
+
+def stats_command(update: Update, context: CallbackContext) -> None:
+    if update.effective_user.id in households.admins:
+        update.message.reply_text(f'```\n{metrics.summary()}\n```', parse_mode='Markdown')
+
+def profile_command(update: Update, context: CallbackContext) -> None:
+    '''profile the next request slower than the optional ms threshold'''
+    if update.effective_user.id in households.admins:
+        try:
+            threshold = float(context.args[0]) / 1000 if context.args else 0.0
+        except ValueError:
+            update.message.reply_text('usage: /profile [ms]')
+            return
+        profiler.arm(update.message.chat_id, threshold)
+        noreply = update.message.reply_text(
+            f'profiling the next request over {threshold * 1000:.0f} ms'
+        )
+        schedule_delete(context, noreply, update.message)
 
 def start_command(update: Update, context: CallbackContext) -> None:
-    if update.message.chat_id not in auth.chats():
-        auth.update_chats(update.message.chat_id)
-    context.job_queue.run_daily(
-        dayly_job,
-        time = notify_time,
-        context=auth.chats
-    )
+    '''`/start household` links a new chat to a household'''
+    chat_id = update.message.chat_id
+    name = households.route(chat_id)
+    if name is None and context.args and context.args[0] in households.names():
+        name = context.args[0]
+    if name is None:
+        return
+    with households.use(name) as household:
+        if not household.auth.ok(update):
+            return
+        households.link(chat_id, name)
+        if chat_id not in household.auth.chats():
+            household.auth.update_chats(chat_id)
+    schedule_daily(context.job_queue)
 
-def help_command(update: Update, context: CallbackContext) -> None:
-    if auth.ok(update):
+def help_command(update: Update, context: CallbackContext, household) -> None:
+    if household.auth.ok(update):
         noreply = update.message.reply_markdown_v2(
             f'`help` \- show this message and exit\n'
             f'`expenses` \- show available expenses categories\n'
@@ -153,43 +325,136 @@ def help_command(update: Update, context: CallbackContext) -> None:
             f'`pocket` \- show pocket money summary\n'
             f'`groceries` \- show month groceries statistics\n'
             f'`target` \- show targets debt summary\n'
+            f'`forecast [months]` \- show the running debt and its forecast\n'
             f'`today` \- show today statistics\n'
-            f'`month` \- show month statistics'
+            f'`month [mm.yyyy]` \- show month statistics\n'
+            f'`range from to` \- show statistics between two dates\n'
+            f'`rebuild` \- recompute month totals from history, admins only\n'
+            f'`import` \- back\-fill expenses from a csv file'
         )
-        time.sleep(10)
-        noreply.delete()
-        update.message.delete()
+        schedule_delete(context, noreply, update.message)
+
+def config_job(context: CallbackContext) -> None:
+    '''pick up edits of budget.json and telegram.json without a restart'''
+    for config_name in configs.poll():
+        logger.info('reloaded %s', config_name)
+
+def household_job(context: CallbackContext) -> None:
+    '''close households nobody used for a while'''
+    evicted = households.evict()
+    if evicted:
+        logger.info('closed %d idle households', evicted)
+
+def serve_webhook(updater: Updater, config: dict, workers: int, warm) -> None:
+    '''take updates from the local webhook server until SIGINT or SIGTERM,
+    telegram posts to the public url and a proxy forwards them here
+    '''
+    server = WebhookServer(
+        updater.dispatcher,
+        config['secret'],
+        host=config.get('host', '127.0.0.1'),
+        port=config.get('port', 8443),
+        path=config.get('path', '/telegram'),
+        queue_size=config.get('queue_size', 256),
+        workers=workers
+    )
+    metrics.gauge('webhook_queue', server.updates.qsize)
+    server.start()
+    updater.job_queue.start()
+    updater.bot.set_webhook(
+        config['url'],
+        secret_token=config['secret'],
+        max_connections=config.get('max_connections', 40)
+    )
+    warm.start()
+    stop = threading.Event()
+    for stop_signal in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(stop_signal, lambda *args: stop.set())
+    while not stop.wait(1):
+        pass
+    server.stop()
+    updater.job_queue.stop()
 
-def load_config(config_name: str) -> dict:
-    with open(config_name, 'r') as config:
-        config = json.load(config)
-        return config
+def add_handlers(dispatcher, run_async: bool = True) -> None:
+    '''register every command and message handler'''
+    # commands of the whole bot
+    commands = {
+        'start': start_command,
+        'stats': stats_command,
+        'profile': profile_command,
+    }
+    # commands answered from the household of the chat
+    household_commands = {
+        'help': help_command,
+        'expenses': expenses_command,
+        'left': left_command,
+        'pocket': pocket_command,
+        'groceries': groceries_command,
+        'target': target_command,
+        'forecast': forecast_command,
+        'today': day_command,
+        'month': month_command,
+        'range': range_command,
+        'rebuild': rebuild_command,
+        'import': import_command,
+    }
+    commands.update(
+        (name, tenant(handler)) for name, handler in household_commands.items()
+    )
+    for name, handler in commands.items():
+        dispatcher.add_handler(CommandHandler(
+            name, instrumented(name, handler), run_async=run_async
+        ))
+    dispatcher.add_handler(MessageHandler(
+        Filters.document & Filters.caption_regex(r'^/import'),
+        instrumented('import_document', tenant(import_document)), run_async=run_async
+    ))
+    dispatcher.add_handler(MessageHandler(
+        Filters.text & ~Filters.command,
+        instrumented('buy', tenant(buy_message)), run_async=run_async
+    ))
 
 def main() -> None:
-    tel_config = load_config('telegram.json')
+    tel_config = configs.load('telegram.json')
     
-    updater = Updater(tel_config['token'], use_context=True)
+    # handlers run on a pool of this many worker threads
+    updater = Updater(
+        tel_config['token'],
+        workers=tel_config.get('workers', 8),
+        use_context=True
+    )
 
-    updater.job_queue.run_daily(
-        dayly_job,
-        time = notify_time,
-        context=auth.chats()
+    schedule_daily(updater.job_queue)
+
+    updater.job_queue.run_repeating(
+        config_job,
+        interval=tel_config.get('config_poll_interval', 30)
     )
 
-    dispatcher = updater.dispatcher
-    dispatcher.add_handler(CommandHandler("start", start_command))
-    dispatcher.add_handler(CommandHandler("help", help_command))
-    dispatcher.add_handler(CommandHandler("expenses", expenses_command))
-    dispatcher.add_handler(CommandHandler("left", left_command))
-    dispatcher.add_handler(CommandHandler("pocket", pocket_command))
-    dispatcher.add_handler(CommandHandler("groceries", groceries_command))
-    dispatcher.add_handler(CommandHandler("target", target_command))
-    dispatcher.add_handler(CommandHandler("today", day_command))
-    dispatcher.add_handler(CommandHandler("month", month_command))
-    dispatcher.add_handler(MessageHandler(Filters.text & ~Filters.command, buy_message))
-
-    updater.start_polling()
-    updater.idle()
+    updater.job_queue.run_repeating(household_job, interval=60)
+
+    if 'metrics_port' in tel_config:
+        # prometheus text format on http://127.0.0.1:<port>/metrics
+        metrics.serve(tel_config['metrics_port'])
+
+    webhook_config = tel_config.get('webhook')
+    # webhook workers run the handlers themselves,
+    # polling hands them to the dispatcher worker threads
+    add_handlers(updater.dispatcher, run_async=webhook_config is None)
+
+    # ledgers load while the first updates arrive
+    warm = threading.Thread(
+        target=households.warm, args=(tel_config.get('warm_households'),),
+        daemon=True
+    )
+    if webhook_config is None:
+        updater.start_polling()
+        warm.start()
+        updater.idle()
+    else:
+        serve_webhook(updater, webhook_config, tel_config.get('workers', 8), warm)
+    # the warm state written here makes the next start fast
+    households.close()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,357 @@
+import os
+import csv
+import re
+import sqlite3
+import threading
+import pandas as pd
+from pay_calc import normalize_currency
+
+COLUMNS = ['date', 'time', 'purpose', 'role', 'amount', 'currency', 'description']
+# in memory the date and time strings become one timestamp column
+FRAME_COLUMNS = ['timestamp', 'purpose', 'role', 'amount', 'currency', 'description']
+CATEGORICAL = ['purpose', 'role', 'currency']
+
+DATE_FORMAT = '%d.%m.%Y'
+TIME_FORMAT = '%H:%M'
+STAMP_FORMAT = '%d.%m.%Y %H:%M'
+
+def to_frame(records: pd.DataFrame) -> pd.DataFrame:
+    ''' storage columns to the in-memory layout '''
+    frames = records.assign(
+        timestamp=pd.to_datetime(
+            records['date'] + ' ' + records['time'],
+            format=STAMP_FORMAT
+        ),
+        description=records['description'].fillna('')
+    )
+    return frames[FRAME_COLUMNS].astype(dict.fromkeys(CATEGORICAL, 'category'))
+
+def to_records(frames: pd.DataFrame) -> pd.DataFrame:
+    ''' in-memory layout back to storage columns '''
+    stamps = frames['timestamp']
+    return frames.assign(
+        date=stamps.dt.strftime(DATE_FORMAT),
+        time=stamps.dt.strftime(TIME_FORMAT)
+    )[COLUMNS].astype(dict.fromkeys(CATEGORICAL, str))
+
+def concat_frames(frames: pd.DataFrame, tail: pd.DataFrame) -> pd.DataFrame:
+    ''' append tail keeping the dtypes of frames, new category
+        values are added without recoding existing rows.
+        frames itself is left untouched, readers may still hold it.
+    '''
+    dtypes = {}
+    for col in CATEGORICAL:
+        categories = frames[col].cat.categories
+        missing = tail[col].cat.categories.difference(categories)
+        if len(missing) > 0:
+            dtypes[col] = pd.CategoricalDtype(categories.append(missing))
+    if dtypes:
+        frames = frames.astype(dtypes)
+    tail = tail.astype(frames.dtypes.to_dict())
+    return pd.concat([frames, tail], ignore_index=True)
+
+def file_state(file_name: str) -> tuple:
+    ''' (mtime, size) of a file, None when it does not exist '''
+    try:
+        stat = os.stat(file_name)
+    except FileNotFoundError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+def read_csv(csv_name: str) -> pd.DataFrame:
+    records = pd.read_csv(csv_name, dtype={'description': str})
+    # legacy files may still carry currency symbols
+    records['currency'] = normalize_currency(records['currency']).astype(str)
+    return to_frame(records)
+
+def write_csv(frames: pd.DataFrame, csv_name: str) -> None:
+    to_records(frames).to_csv(csv_name, index=False)
+
+class Storage:
+    # partitioned storages load single months on demand
+    partitioned = False
+
+    def empty(self) -> bool:
+        return len(self) == 0
+
+    def close(self) -> None:
+        pass
+
+    def tidy(self) -> None:
+        ''' housekeeping a full load would do, for callers that skip it '''
+        pass
+
+    def signature(self) -> tuple:
+        ''' changes whenever the stored records may have changed,
+            None when the storage cannot tell
+        '''
+        return None
+
+    def migrate_csv(self, csv_name: str) -> int:
+        ''' one-shot import of the legacy grossbook.csv,
+            only done while the storage is still empty.
+        '''
+        if not self.empty() or not os.path.exists(csv_name):
+            return 0
+        frames = read_csv(csv_name)
+        self.write(frames)
+        return len(frames)
+
+class SqliteStorage(Storage):
+    ''' Append-only grossbook kept in an embedded SQLite table.
+        Every record is one INSERT, so a purchase costs O(1)
+        disk work instead of rewriting the whole history.
+    '''
+    def __init__(self, file_name: str) -> None:
+        self.file_name = file_name
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(file_name, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS grossbook ('
+            'id INTEGER PRIMARY KEY AUTOINCREMENT, '
+            'date TEXT, time TEXT, purpose TEXT, role TEXT, '
+            'amount REAL, currency TEXT, description TEXT)'
+        )
+        self.connection.commit()
+
+    def __len__(self) -> int:
+        with self.lock:
+            return self.connection.execute(
+                'SELECT COUNT(*) FROM grossbook'
+            ).fetchone()[0]
+
+    def load(self) -> pd.DataFrame:
+        with self.lock:
+            records = pd.read_sql_query(
+                f'SELECT {", ".join(COLUMNS)} FROM grossbook ORDER BY id',
+                self.connection
+            )
+        return to_frame(records)
+
+    def append(self, records: list) -> None:
+        ''' write records in a single transaction '''
+        rows = [tuple(rec[col] for col in COLUMNS) for rec in records]
+        with self.lock, self.connection:
+            self.connection.executemany(
+                f'INSERT INTO grossbook ({", ".join(COLUMNS)}) '
+                f'VALUES ({", ".join("?" * len(COLUMNS))})',
+                rows
+            )
+
+    def write(self, frames: pd.DataFrame) -> None:
+        self.append(to_records(frames).to_dict('records'))
+
+    def close(self) -> None:
+        with self.lock:
+            self.connection.close()
+
+    def signature(self) -> tuple:
+        # an open database has an empty wal, a crashed one a filled wal
+        wal = file_state(self.file_name + '-wal')
+        return file_state(self.file_name), wal[1] if wal else 0
+
+class ArrowStorage(Storage):
+    ''' Columnar grossbook in an Arrow IPC file, memory mapped on
+        load: amounts and timestamps are read straight from the page
+        cache, purpose, role and currency are dictionary encoded.
+        New records go to a csv journal next to it and are folded
+        into the file once the journal grows past compact_rows.
+        Needs pyarrow.
+    '''
+    def __init__(self, file_name: str, compact_rows: int = 10000) -> None:
+        import pyarrow
+        import pyarrow.ipc
+        self.pa = pyarrow
+        self.file_name = file_name
+        self.journal_name = file_name + '.journal'
+        self.compact_rows = compact_rows
+        self.lock = threading.Lock()
+        # one memory map of the arrow file, renewed when compaction replaces it
+        self.source = None
+        self.source_state = None
+        dictionary = pyarrow.dictionary(pyarrow.int32(), pyarrow.string())
+        self.schema = pyarrow.schema([
+            ('timestamp', pyarrow.timestamp('s')),
+            ('purpose', dictionary),
+            ('role', dictionary),
+            ('amount', pyarrow.float64()),
+            ('currency', dictionary),
+            ('description', pyarrow.string()),
+        ])
+
+    def __len__(self) -> int:
+        rows = 0
+        with self.lock:
+            if os.path.exists(self.file_name):
+                rows += self._read_table().num_rows
+            return rows + self._journal_rows()
+
+    def load(self) -> pd.DataFrame:
+        with self.lock:
+            if os.path.exists(self.file_name):
+                # descriptions stay arrow strings instead of python objects
+                frames = self._read_table().to_pandas(types_mapper={
+                    self.pa.string(): pd.StringDtype('pyarrow')
+                }.get)
+            else:
+                frames = to_frame(pd.DataFrame(columns=COLUMNS))
+            journal_rows = self._journal_rows()
+            if journal_rows > 0:
+                journal = pd.read_csv(
+                    self.journal_name, names=COLUMNS, header=None,
+                    dtype={'description': str}
+                )
+                frames = concat_frames(frames, to_frame(journal))
+            if journal_rows >= self.compact_rows:
+                self._compact(frames)
+        return frames
+
+    def append(self, records: list) -> None:
+        with self.lock, open(self.journal_name, 'a', newline='') as journal:
+            csv.writer(journal).writerows(
+                [rec[col] for col in COLUMNS] for rec in records
+            )
+            journal.flush()
+            os.fsync(journal.fileno())
+
+    def write(self, frames: pd.DataFrame) -> None:
+        if len(self) == 0:
+            with self.lock:
+                self._compact(frames)
+        else:
+            self.append(to_records(frames).to_dict('records'))
+
+    def compact(self) -> None:
+        ''' fold the journal into the arrow file '''
+        frames = self.load()
+        with self.lock:
+            self._compact(frames)
+
+    def tidy(self) -> None:
+        # warm starts never load(), the journal is folded in here instead
+        with self.lock:
+            due = self._journal_rows() >= self.compact_rows
+        if due:
+            self.compact()
+
+    def close(self) -> None:
+        with self.lock:
+            if self.source is not None:
+                self.source.close()
+                self.source = self.source_state = None
+
+    def signature(self) -> tuple:
+        return file_state(self.file_name), file_state(self.journal_name)
+
+    def _read_table(self):
+        # pages are mapped, not read; columns point into the file
+        state = file_state(self.file_name)
+        if self.source is None or self.source_state != state:
+            if self.source is not None:
+                self.source.close()
+            self.source = self.pa.memory_map(self.file_name)
+            self.source_state = state
+        return self.pa.ipc.open_file(self.source).read_all()
+
+    def _journal_rows(self) -> int:
+        if not os.path.exists(self.journal_name):
+            return 0
+        with open(self.journal_name, newline='') as journal:
+            return sum(1 for _ in csv.reader(journal))
+
+    def _compact(self, frames: pd.DataFrame) -> None:
+        table = self.pa.Table.from_pandas(
+            frames[FRAME_COLUMNS], preserve_index=False
+        ).cast(self.schema)
+        temp_name = self.file_name + '.tmp'
+        with self.pa.OSFile(temp_name, 'wb') as sink:
+            with self.pa.ipc.new_file(sink, self.schema) as writer:
+                writer.write_table(table)
+        os.replace(temp_name, self.file_name)
+        if os.path.exists(self.journal_name):
+            os.remove(self.journal_name)
+
+# YYYY-MM.csv
+PARTITION_NAME = re.compile(r'(\d{4})-(\d{2})\.csv')
+
+class PartitionedStorage(Storage):
+    ''' A directory with one append-only csv per month, YYYY-MM.csv,
+        so a month can be loaded without touching the rest.
+    '''
+    partitioned = True
+
+    def __init__(self, dir_name: str) -> None:
+        self.dir_name = dir_name
+        self.lock = threading.Lock()
+        os.makedirs(dir_name, exist_ok=True)
+
+    def __len__(self) -> int:
+        rows = 0
+        for year, month in self.months():
+            with open(self._path(year, month), newline='') as partition:
+                rows += sum(1 for _ in csv.reader(partition))
+        return rows
+
+    def empty(self) -> bool:
+        return not self.months()
+
+    def months(self) -> list:
+        months = []
+        for name in os.listdir(self.dir_name):
+            # backups or exports lying next to the partitions are skipped
+            match = PARTITION_NAME.fullmatch(name)
+            if match:
+                months.append((int(match.group(1)), int(match.group(2))))
+        return sorted(months)
+
+    def has_month(self, year: int, month: int) -> bool:
+        return os.path.exists(self._path(year, month))
+
+    def load(self) -> pd.DataFrame:
+        frames = to_frame(pd.DataFrame(columns=COLUMNS))
+        for year, month in self.months():
+            frames = concat_frames(frames, self.load_month(year, month))
+        return frames
+
+    def load_month(self, year: int, month: int) -> pd.DataFrame:
+        path = self._path(year, month)
+        if not os.path.exists(path):
+            return to_frame(pd.DataFrame(columns=COLUMNS))
+        with self.lock:
+            records = pd.read_csv(
+                path, names=COLUMNS, header=None, dtype={'description': str}
+            )
+        return to_frame(records)
+
+    def append(self, records: list) -> None:
+        partitions = {}
+        for rec in records:
+            day, month, year = rec['date'].split('.')
+            partitions.setdefault((int(year), int(month)), []).append(rec)
+        with self.lock:
+            for (year, month), month_records in partitions.items():
+                with open(self._path(year, month), 'a', newline='') as partition:
+                    csv.writer(partition).writerows(
+                        [rec[col] for col in COLUMNS] for rec in month_records
+                    )
+                    partition.flush()
+                    os.fsync(partition.fileno())
+
+    def write(self, frames: pd.DataFrame) -> None:
+        self.append(to_records(frames).to_dict('records'))
+
+    def _path(self, year: int, month: int) -> str:
+        return os.path.join(self.dir_name, f'{year:04d}-{month:02d}.csv')
+
+def open_storage(file_name: str) -> Storage:
+    ''' storage backend by file extension: .arrow/.feather columnar,
+        no extension a directory of month partitions, sqlite otherwise
+    '''
+    ext = os.path.splitext(file_name)[1]
+    if ext in ('.arrow', '.feather'):
+        return ArrowStorage(file_name)
+    if not ext:
+        return PartitionedStorage(file_name)
+    return SqliteStorage(file_name)
@@ -0,0 +1,118 @@
+import hmac
+import json
+import queue
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from telegram import Update
+
+logger = logging.getLogger(__name__)
+
+# telegram sends this header with the secret given to setWebhook
+SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+class WebhookServer:
+    ''' Receives telegram updates as json POSTs on a local port,
+        usually behind a tls terminating proxy. Requests without the
+        secret token are refused. Accepted updates wait in a bounded
+        queue for the worker threads, which run the dispatcher
+        handlers. While the queue stays full requests are answered
+        503, telegram keeps such updates and delivers them again.
+    '''
+    def __init__(self, dispatcher, secret: str,
+                 host: str = '127.0.0.1', port: int = 8443,
+                 path: str = '/telegram', queue_size: int = 256,
+                 workers: int = 8, put_timeout: float = 1.0,
+                 max_body: int = 2**20) -> None:
+        self.dispatcher = dispatcher
+        self.secret = secret.encode()
+        self.path = path
+        self.updates = queue.Queue(queue_size)
+        self.put_timeout = put_timeout
+        self.max_body = max_body
+        self.workers = [
+            threading.Thread(target=self._work, name=f'webhook-{num}', daemon=True)
+            for num in range(workers)
+        ]
+        self.server = ThreadingHTTPServer((host, port), self._handler())
+        self.server.daemon_threads = True
+
+    @property
+    def address(self) -> tuple:
+        return self.server.server_address
+
+    def start(self) -> None:
+        for worker in self.workers:
+            worker.start()
+        threading.Thread(
+            target=self.server.serve_forever, name='webhook-server', daemon=True
+        ).start()
+
+    def stop(self) -> None:
+        ''' stop accepting, finish what is queued '''
+        self.server.shutdown()
+        self.server.server_close()
+        for worker in self.workers:
+            self.updates.put(None)
+        for worker in self.workers:
+            worker.join()
+
+    def feed(self, data: dict) -> bool:
+        ''' queue one update, False when the queue stayed full '''
+        update = Update.de_json(data, self.dispatcher.bot)
+        try:
+            self.updates.put(update, timeout=self.put_timeout)
+        except queue.Full:
+            return False
+        return True
+
+    def _work(self) -> None:
+        while True:
+            update = self.updates.get()
+            if update is None:
+                return
+            try:
+                self.dispatcher.process_update(update)
+            except Exception:
+                logger.exception('update %s failed', update.update_id)
+
+    def _handler(self):
+        webhook = self
+
+        class UpdateHandler(BaseHTTPRequestHandler):
+            # keep-alive, telegram reuses its connections
+            protocol_version = 'HTTP/1.1'
+
+            def do_POST(self) -> None:
+                length = int(self.headers.get('Content-Length') or 0)
+                if length > webhook.max_body:
+                    # the body stays unread, the connection cannot be reused
+                    self.close_connection = True
+                    self._reply(413)
+                    return
+                body = self.rfile.read(length)
+                if self.path != webhook.path:
+                    self._reply(404)
+                    return
+                secret = self.headers.get(SECRET_HEADER, '').encode()
+                if not hmac.compare_digest(secret, webhook.secret):
+                    self._reply(403)
+                    return
+                try:
+                    accepted = webhook.feed(json.loads(body))
+                except (ValueError, TypeError, KeyError, AttributeError):
+                    self._reply(400)
+                    return
+                self._reply(200 if accepted else 503)
+
+            def _reply(self, status: int) -> None:
+                self.send_response(status)
+                if self.close_connection:
+                    self.send_header('Connection', 'close')
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            def log_message(self, format, *args) -> None:
+                pass
+
+        return UpdateHandler